@@ -2,16 +2,20 @@
 Exercise main application, and container entry point.
 """
 
+import argparse
 import logging
 
 from TemperatureHistogram.geolocation import GeoBuilder, LocationDB
+from TemperatureHistogram.handlers import debug_sampler, setup_logging
 from TemperatureHistogram.histogram import Histogram
 from TemperatureHistogram.log_input import LogParser
 from TemperatureHistogram.settings import app_settings
-from TemperatureHistogram.weather import update_forecast_high_temperatures, forecast_high_temperature_list
+from TemperatureHistogram.weather import (
+    forecast_temperature_chunks, forecast_temperature_range, forecast_temperature_sample, purge_forecast_cache,
+    update_forecast_high_temperatures, warm_forecast_cache)
 
 
-def app_setup(func):  # TODO: Implement an asynchronous logging handler ala Logbook to increase DEBUG performance.
+def app_setup(func):
     """
     Basic application setup.
     """
@@ -19,17 +23,11 @@ def app_setup(func):  # TODO: Implement an asynchronous logging handler ala Logb
     # Logging format
     formatter = "[TemperatureHistogram] %(asctime)s %(levelname)-s: " + "%(message)s"
 
-    # File (DEBUG) logging
-    logging.basicConfig(level=logging.DEBUG, format=formatter, filename='/data/output.log', filemode='w')
+    # File (DEBUG) and console (INFO) logging, written by a background listener
+    setup_logging(formatter, '/data/output.log')
 
-    # Console (INFO) handler
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(logging.Formatter(formatter))
-    console_handler.setLevel(logging.INFO)
-
-    # Logger and handlers
-    logger = logging.getLogger()
-    logger.addHandler(console_handler)
+    # Hot loop DEBUG sampling. Settings are referenced once logging is set up, as they log their population.
+    debug_sampler.rate = app_settings['debug_sample_rate']
 
     # Initialize location database
     location_db = LocationDB()
@@ -43,8 +41,8 @@ def main():
     """
     Parses log file, populates location database, and produces forecast high temperature histogram for locations.
 
-    Always assumes log file is new, or contains new data, and thus does not check file hash, or entries found within
-    existing location database.
+    Unless disabled, log file evaluation resumes from the checkpoint saved by the previous run, so only lines appended
+    since are parsed. Rotated or truncated log files are detected, and parsed from the start.
     """
 
     # Announce that we're starting
@@ -58,32 +56,98 @@ def main():
     logging.info("Completed parsing log file.")
 
     # Geolocate IPs found in log file
-    logging.info("Starting geolocation of IPs and writing results to location database.")
-    g = GeoBuilder()
-    g.build_locations(ip_list)
-    logging.info("Completed geolocation of IPs and writing results to location database.")
+    if len(ip_list):
+        logging.info("Starting geolocation of IPs and writing results to location database.")
+        g = GeoBuilder()
+        g.build_locations(ip_list)
+        logging.info("Completed geolocation of IPs and writing results to location database.")
+        g.record_hits(ip_list, log.ip_counts, accumulate=log.incremental)
+    log.commit_checkpoint()
 
     # Populate location forecast information
     logging.info("Starting populating location latest forecast high temperatures.")
     update_forecast_high_temperatures()
     logging.info("Completed populating location latest forecast high temperatures.")
 
-    # Construct temperature list needed for histogram
-    logging.info("Starting building of location temperature list.")
-    temperature_list = forecast_high_temperature_list()
-    logging.info("Completed building location temperature list.")
-
-    # Produce histogram, and save as tab delimited file
+    # Produce histogram, streaming location temperatures from the location database, and output it
     logging.info("Starting production of histogram.")
-    h = Histogram(temperature_list)
+    sample = forecast_temperature_sample()
+    group_by = app_settings['histogram_group_by']
+    h = Histogram(forecast_temperature_range(), sample, group_by=group_by)
+    for temperatures, weights, strata, groups in forecast_temperature_chunks(
+            app_settings['histogram_weighting'], sample, group_by):
+        h.accumulate(temperatures, weights, strata, groups)
     h.build_histogram()
     h.save_histogram()
-    h.display_histogram()
+    h.display_percentiles()
+    if app_settings['summary_output']:
+        h.save_summary(app_settings['summary_output'])
     logging.info("Completed production of histogram.")
 
     # Announce that we're done
     logging.info("All done!")
 
 
+def maintain_forecast_cache(args):
+    """
+    Purges, and/or warms, the forecast cache instead of a full application run.
+
+    :param args: Parsed command line arguments.
+    """
+
+    if args.purge_forecast_cache:
+        logging.info("Starting purging of {} forecast cache entries.".format(args.purge_forecast_cache))
+        purge_forecast_cache(expired_only=args.purge_forecast_cache == 'expired')
+        logging.info("Completed purging of forecast cache.")
+    if args.warm_forecast_cache:
+        logging.info("Starting warming of forecast cache.")
+        warm_forecast_cache()
+        logging.info("Completed warming of forecast cache.")
+
+
+def merge_summaries(filenames):
+    """
+    Merges histogram summaries saved by separate runs, e.g. one per log source or host, and produces their histogram
+    instead of a full application run.
+
+    :param filenames: List of histogram summary filenames.
+    """
+
+    logging.info("Starting merging of {} histogram summaries.".format(len(filenames)))
+    h = Histogram.merged(filenames)
+    h.build_histogram()
+    h.save_histogram()
+    h.display_percentiles()
+    if app_settings['summary_output']:
+        h.save_summary(app_settings['summary_output'])
+    logging.info("Completed merging of histogram summaries.")
+
+
+def parse_args():
+    """
+    Parses command line arguments.
+
+    :return: Parsed command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(prog='TemperatureHistogram')
+    parser.add_argument(
+        '--purge-forecast-cache', choices=('expired', 'all'),
+        help="Purge expired, or all, forecast cache entries, and exit.")
+    parser.add_argument(
+        '--warm-forecast-cache', action='store_true',
+        help="Fetch forecasts for every location grid cell missing from the forecast cache, and exit.")
+    parser.add_argument(
+        '--merge-summaries', nargs='+', metavar='SUMMARY',
+        help="Merge histogram summaries saved by separate runs into a single histogram, and exit.")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    main()
+    arguments = parse_args()
+    if arguments.merge_summaries:
+        merge_summaries(arguments.merge_summaries)
+    elif arguments.purge_forecast_cache or arguments.warm_forecast_cache:
+        maintain_forecast_cache(arguments)
+    else:
+        main()
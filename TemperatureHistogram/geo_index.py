@@ -0,0 +1,194 @@
+"""
+Exercise geolocation index module.
+"""
+
+import io
+import logging
+import os
+
+import maxminddb
+import numpy as np
+
+from TemperatureHistogram.sinks import write_atomically
+
+
+class GeoIndex(object):
+    """
+    Flattened copy of the geolocation reference database's IPv4 networks, as sorted NumPy arrays of network start and
+    end addresses, each pointing into a deduplicated table of places. Whole IP arrays are geolocated with a single
+    `searchsorted` call, rather than walking the database tree, and building a `City` model object, per IP.
+
+    The index is compiled once, and cached next to the geolocation reference database. The cache is compiled again
+    whenever the geolocation reference database changes.
+    """
+
+    def __init__(self, starts, ends, places, latitudes, longitudes, cities, regions, countries):
+        """
+
+        :param starts: Sorted array of network start addresses as unsigned 32-bit integers.
+        :param ends: Array of network end (last) addresses as unsigned 32-bit integers.
+        :param places: Array of each network's place table index.
+        :param latitudes: Place table latitudes, NaN when unknown.
+        :param longitudes: Place table longitudes, NaN when unknown.
+        :param cities: Place table city names, empty when unknown.
+        :param regions: Place table ISO 3166-2 principal subdivision codes, empty when unknown.
+        :param countries: Place table ISO 3166-1 alpha-2 country codes, empty when unknown.
+        """
+        self.starts = starts
+        self.ends = ends
+        self.places = places
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.cities = cities
+        self.regions = regions
+        self.countries = countries
+
+    @staticmethod
+    def _source(geo_db):
+        """
+        Identify the geolocation reference database an index is compiled from.
+
+        :param geo_db: Geolocation reference database filename.
+        :return: Array of file size, modification time, and database build epoch.
+        """
+
+        stat = os.stat(geo_db)
+        with maxminddb.open_database(geo_db) as reader:
+            build_epoch = reader.metadata().build_epoch
+        return np.array([stat.st_size, stat.st_mtime_ns, build_epoch], dtype=np.int64)
+
+    @staticmethod
+    def _iter_ipv4_networks(reader):
+        """
+        Walk the IPv4 part of the geolocation reference database's search tree, in address order.
+
+        :param reader: Pure Python `maxminddb` reader, i.e. opened with `MODE_MMAP`, `MODE_FILE`, or `MODE_MEMORY`.
+        :return: Generator of network start and end addresses, and the network's data pointer.
+        """
+
+        node_count = reader._metadata.node_count
+        stack = [(reader._start_node(32), 0, 0)]
+        while stack:
+            node, depth, prefix = stack.pop()
+            if node > node_count:
+                yield prefix << 32 - depth, (prefix + 1 << 32 - depth) - 1, node
+            elif node < node_count and depth < 32:
+                # Push right before left, so the left (lower) half is walked first
+                stack.append((reader._read_node(node, 1), depth + 1, prefix << 1 | 1))
+                stack.append((reader._read_node(node, 0), depth + 1, prefix << 1))
+
+    @classmethod
+    def compile_(cls, geo_db):
+        """
+        Compile index from the geolocation reference database. Records are decoded once per distinct data pointer, and
+        neighbouring networks sharing a place are merged.
+
+        :param geo_db: Geolocation reference database filename.
+        :return: `GeoIndex`.
+        """
+
+        starts, ends, places = [], [], []
+        place_table = {}  # Place tuple to place table index
+        pointer_places = {}  # Data pointer to place table index
+        with maxminddb.open_database(geo_db, maxminddb.MODE_MMAP) as reader:
+            for start, end, pointer in cls._iter_ipv4_networks(reader):
+                place = pointer_places.get(pointer)
+                if place is None:
+                    record = reader._resolve_data_pointer(pointer) or {}
+                    location = record.get('location', {})
+                    subdivisions = record.get('subdivisions') or [{}]
+                    place = place_table.setdefault((
+                        location.get('latitude', np.nan),
+                        location.get('longitude', np.nan),
+                        record.get('city', {}).get('names', {}).get('en') or '',
+                        subdivisions[-1].get('iso_code') or '',
+                        record.get('country', {}).get('iso_code') or ''), len(place_table))
+                    pointer_places[pointer] = place
+                if ends and ends[-1] + 1 == start and places[-1] == place:
+                    ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+                    places.append(place)
+        columns = list(zip(*place_table)) or [(), (), (), (), ()]
+        return cls(
+            np.array(starts, dtype=np.uint32), np.array(ends, dtype=np.uint32), np.array(places, dtype=np.int32),
+            np.array(columns[0], dtype=np.float64), np.array(columns[1], dtype=np.float64),
+            np.array(columns[2], dtype=str), np.array(columns[3], dtype=str), np.array(columns[4], dtype=str))
+
+    def save_(self, filename, source):
+        """
+        Save index, replacing any existing file atomically.
+
+        :param filename: Index cache filename.
+        :param source: Array identifying the geolocation reference database compiled from.
+        """
+
+        f = io.BytesIO()
+        np.savez(
+            f, source=source, starts=self.starts, ends=self.ends, places=self.places, latitudes=self.latitudes,
+            longitudes=self.longitudes, cities=self.cities, regions=self.regions, countries=self.countries)
+        write_atomically(filename, f.getvalue())
+
+    @classmethod
+    def load(cls, geo_db):
+        """
+        Load index cached next to the geolocation reference database, compiling and caching it first if it's missing,
+        or was compiled from a different geolocation reference database.
+
+        :param geo_db: Geolocation reference database filename.
+        :return: `GeoIndex`.
+        """
+
+        filename = geo_db + '.index.npz'
+        source = cls._source(geo_db)
+        try:
+            with np.load(filename) as cache:
+                if np.array_equal(cache['source'], source):
+                    logging.debug("Loaded geolocation index '{}'.".format(filename))
+                    return cls(*(cache[k] for k in (
+                        'starts', 'ends', 'places', 'latitudes', 'longitudes', 'cities', 'regions', 'countries')))
+            logging.info("Geolocation reference database changed since its index was compiled.")
+        except (OSError, KeyError, ValueError):
+            logging.info("No usable geolocation index found at '{}'.".format(filename))
+        logging.info("Compiling geolocation index from '{}'. This is only done once per database.".format(geo_db))
+        index = cls.compile_(geo_db)
+        logging.info(
+            "Compiled geolocation index of {} IPv4 networks, and {} places."
+            .format(len(index.starts), len(index.cities)))
+        try:
+            index.save_(filename, source)
+        except OSError as e:
+            logging.warning("Unable to cache geolocation index at '{}': {}".format(filename, e))
+        return index
+
+    def lookup(self, ips):
+        """
+        Geolocate IP addresses.
+
+        :param ips: Array of IP addresses as unsigned 32-bit integers.
+        :return: Boolean array of whether each IP was found, and array of each IP's place table index (only meaningful
+        where found).
+        """
+
+        ips = np.asarray(ips, dtype=np.uint32)
+        networks = np.searchsorted(self.starts, ips, side='right') - 1
+        found = networks >= 0
+        networks[~found] = 0
+        if len(self.starts):
+            found &= ips <= self.ends[networks]
+            return found, self.places[networks]
+        return found, np.zeros(len(ips), dtype=np.int32)
+
+    def place(self, place):
+        """
+        Look up place table entry.
+
+        :param place: Place table index.
+        :return: Tuple of latitude, longitude, city, region, and country, each None when unknown.
+        """
+
+        latitude, longitude = float(self.latitudes[place]), float(self.longitudes[place])
+        return (
+            None if np.isnan(latitude) else latitude, None if np.isnan(longitude) else longitude,
+            str(self.cities[place]) or None, str(self.regions[place]) or None, str(self.countries[place]) or None)
@@ -4,14 +4,154 @@ Exercise geolocation module.
 
 import datetime
 import geoip2.database
+import geoip2.errors
 from ipaddress import AddressValueError
 import logging
+import maxminddb
 import multiprocessing
 import sqlite3
+import time
+from operator import itemgetter
 
-from TemperatureHistogram.handlers import GracefulException
+import numpy as np
+
+from TemperatureHistogram.geo_index import GeoIndex
+from TemperatureHistogram.handlers import GracefulException, debug_sampler, flush_logging
 from TemperatureHistogram.settings import app_settings
 
+GEOLOCATION_BATCH_SIZE = 250  # IPs handed to a geolocation process at a time
+WRITE_BATCH_SIZE = 50000  # Rows written per location database transaction
+READ_BATCH_SIZE = 50000  # Rows read per location database fetch, when streamed
+# Re-geolocated locations keep their forecast, unless they moved
+INSERT_LOCATION_SQL = '''
+    INSERT INTO locations
+    (ip, ip_epoch, geolocated, latitude, longitude, city, region, country, forecast_temperature, forecast_epoch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (ip) DO UPDATE SET
+    ip_epoch = excluded.ip_epoch, geolocated = excluded.geolocated, latitude = excluded.latitude,
+    longitude = excluded.longitude, city = excluded.city, region = excluded.region, country = excluded.country,
+    forecast_epoch = CASE
+    WHEN latitude = excluded.latitude AND longitude = excluded.longitude THEN forecast_epoch ELSE 0 END
+    '''
+INSERT_GEO_CACHE_SQL = '''
+    INSERT OR REPLACE INTO geo_cache
+    (network_start, network_end, latitude, longitude, city, region, country, build_epoch, last_used)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+TOUCH_GEO_CACHE_SQL = 'UPDATE geo_cache SET last_used = ? WHERE network_start = ?'
+_reader = None  # Geolocation process' own geolocation reference database reader
+_cache = None  # Geolocation process' snapshot of the network geolocation cache
+
+
+def _init_geolocation_process(geo_db, cache):
+    """
+    Geolocation process initializer. Opens the process' geolocation reference database reader once, memory-mapped, so
+    processes share the database's pages rather than each reading a copy.
+
+    :param geo_db: Geolocation reference database filename.
+    :param cache: `NetworkCache` snapshot of the network geolocation cache.
+    """
+
+    global _reader, _cache
+    # Memory-mapped by the C extension when available, falling back to the pure Python memory-mapped reader
+    _reader = geoip2.database.Reader(geo_db, mode=maxminddb.MODE_AUTO)
+    _cache = cache
+
+
+def _geolocate_ip_batch(ip_batch):
+    """
+    Geolocate an IP list batch. The geolocation reference database is only looked up once per network, as IPs within a
+    network the network geolocation cache snapshot holds, or within the network most recently looked up, share its
+    location.
+
+    :param ip_batch: Sorted array of IP addresses as unsigned 32-bit integers.
+    :return: List of location rows, as expected by `INSERT_LOCATION_SQL`, list of newly looked up networks, as expected
+    by `INSERT_GEO_CACHE_SQL` less its epochs, and set of cached network start addresses used.
+    """
+
+    logging.debug("Process started to geolocate IP list batch containing %s IPs.", len(ip_batch))
+    rows = []
+    networks = []
+    used = set()
+    network = None  # Start and end address, and place of the network most recently looked up
+
+    for ip, entry in zip(ip_batch.tolist(), _cache.lookup(ip_batch).tolist()):
+        # Pseudo schema and Default values for location entry
+        ip_epoch = datetime.datetime.now().strftime('%s')  # Epoch when location was written
+        place = None  # Latitude, longitude, city, region (ISO 3166-2), and country (ISO 3166-1 alpha-2)
+        forecast_temperature = 0.0
+        # forecast_epoch = gen_epoch(0)  # Set initial epoch to coincide with "today"
+        forecast_epoch = 0  # Set initial epoch to effectively "none"
+
+        if entry >= 0:
+            place = _cache.places[entry]
+            used.add(_cache.starts[entry])
+        elif network is not None and network[0] <= ip <= network[1]:
+            place = network[2]
+        else:
+            # Geolocate IP address
+            try:
+                response = _reader.city(ip_to_str(ip))
+                place = (
+                    response.location.latitude, response.location.longitude, response.city.name,
+                    response.subdivisions.most_specific.iso_code, response.country.iso_code)
+                network = (
+                    int(response.traits.network.network_address), int(response.traits.network.broadcast_address),
+                    place)
+                networks.append(network[:2] + place)
+                if debug_sampler.sample():
+                    logging.debug(
+                        "Successfully geolocated IP address '%s' to latitude: '%s' longitude: '%s', network '%s'.",
+                        ip_to_str(ip), place[0], place[1], str(response.traits.network))
+            except (AddressValueError, geoip2.errors.AddressNotFoundError):
+                if debug_sampler.sample():
+                    logging.debug(
+                        "Failed to geolocate IP address '%s'! IP not found in geolocation reference database.",
+                        ip_to_str(ip))
+
+        if place is None:
+            rows.append((ip_to_str(ip), ip_epoch, 0, 0.0, 0.0, "", "", "", forecast_temperature, forecast_epoch))
+        else:
+            rows.append((ip_to_str(ip), ip_epoch, 1) + place + (forecast_temperature, forecast_epoch))
+    flush_logging()
+    return rows, networks, used
+
+
+class NetworkCache(object):
+    """
+    Snapshot of the network geolocation cache, i.e. the location database 'geo_cache' table, as sorted network start
+    and end address arrays, and their places. Handed to geolocation processes, which look up whole IP list batches with
+    a single `searchsorted` call.
+    """
+
+    def __init__(self, rows=()):
+        """
+
+        :param rows: Table rows, ordered as network start and end addresses, latitude, longitude, city, region, and
+        country.
+        """
+        rows = sorted(rows)
+        self.starts = [row[0] for row in rows]
+        self.ends = np.array([row[1] for row in rows], dtype=np.uint32)
+        self.places = [tuple(row[2:7]) for row in rows]
+        self._starts = np.array(self.starts, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, ips):
+        """
+        Find cached networks containing IP addresses.
+
+        :param ips: Array of IP addresses as unsigned 32-bit integers.
+        :return: Array of each IP's cache entry index, or -1 where not cached.
+        """
+
+        entries = np.searchsorted(self._starts, ips, side='right') - 1
+        if len(self.starts):
+            entries[(entries < 0) | (ips > self.ends[np.maximum(entries, 0)])] = -1
+        return entries
+
 
 class GeoBuilder(object):
     """
@@ -35,104 +175,289 @@ class GeoBuilder(object):
         except ValueError:
             raise GracefulException("Invalid geolocation reference database!")
 
-    def _process_ip_list_slice(self, p, list_slice):
+    @staticmethod
+    def _new_ips(ip_list):
         """
-        Processes an IP list slice, and writes locations to location database.
+        Remove IPs already within the location database from an IP list, using a single bulk read of the database.
 
-        :param p: Multiprocess process number.
-        :param list_slice: IP list slice to process.
-        """
+        When `ip_epoch_max_age` is set, locations geolocated longer ago than that many days aren't removed, so they're
+        geolocated again.
 
-        logging.debug("Process {} started to process IP list slice containing {} IPs.".format(p, len(list_slice)))
-        location_db = LocationDB()
-
-        for ip in list_slice:
-
-            # Pseudo schema and Default values for location entry
-            ip_epoch = datetime.datetime.now().strftime('%s')  # Epoch when location was written
-            geolocated = 0  # Whether or not the IP was geolocated
-            latitude = 0.0  # Latitude in decimal degrees format
-            longitude = 0.0  # Longitude in decimal degrees format
-            city = ""  # City name
-            region = ""  # ISO 3166-2 principal subdivision code
-            country = ""  # ISO 3166-1 alpha-2 country code
-            forecast_temperature = 0.0
-            # forecast_epoch = gen_epoch(0)  # Set initial epoch to coincide with "today"
-            forecast_epoch = 0  # Set initial epoch to effectively "none"
+        :param ip_list: Sorted array of unique IP addresses as unsigned 32-bit integers.
+        :return: Sorted array of IP addresses that need geolocating.
+        """
 
-            # Geolocate IP address
-            try:
-                response = self.reader.city(ip)
-                geolocated = 1
-                latitude = response.location.latitude
-                longitude = response.location.longitude
-                city = response.city.name
-                region = response.subdivisions.most_specific.iso_code
-                country = response.country.iso_code
-                logging.debug(
-                    "Successfully geolocated IP address '{}' to latitude: '{}' longitude: '{})"
-                    .format(ip, latitude, longitude))
-            except AttributeError:
-                # This is not likely to happen, but should 'geodb' object fail, handle it
-                raise GracefulException(
-                    "Geolocation reference database object is invalid! Database was either not found previously, and "
-                    "exception handling failed, or the database is no longer locked to us.")
-            except AddressValueError:
-                logging.debug(
-                    "Failed to geolocate IP address '{}'! IP not found in geolocation reference database."
-                    .format(ip))
-
-            # Write location to location database
-            location_db.insert_(
-                '''
-                INSERT OR IGNORE INTO locations 
-                (ip, ip_epoch, geolocated, latitude, longitude, city, region, country, 
-                forecast_temperature, forecast_epoch)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                '''.format(ip),
-                ip, ip_epoch,geolocated, latitude, longitude, city, region, country,
-                forecast_temperature, forecast_epoch)
+        max_age = app_settings['ip_epoch_max_age']
+        if max_age > 0:
+            rows = LocationDB().select_(
+                'SELECT ip FROM locations WHERE ip_epoch >= ?', int(time.time()) - max_age * 86400)
+        else:
+            rows = LocationDB().select_('SELECT ip FROM locations')
+        known = np.fromiter((ip_to_int(row[0]) for row in rows), dtype=np.uint32, count=len(rows))
+        new_ips = np.setdiff1d(ip_list, known, assume_unique=True)
+        logging.info(
+            "{} of {} IPs are already within the location database, and don't need geolocating."
+            .format(len(ip_list) - len(new_ips), len(ip_list)))
+        return new_ips
 
     def build_locations(self, ip_list):
         """
         Builds location database entry composed of geolocation information for a given list of IP addresses.
 
-        :param ip_list: List of IP addresses
+        Only IPs not yet within the location database, or due to be geolocated again, are geolocated. When
+        `geo_index` is set, they're geolocated in bulk against a network range index, otherwise geolocation processes
+        return their locations to this (parent) process, which is the location database's single writer, so processes
+        don't contend for the database lock.
+
+        :param ip_list: Array of IP addresses as unsigned 32-bit integers.
         """
 
+        ip_list = self._new_ips(ip_list)
+        if not len(ip_list):
+            logging.info("No new IPs to geolocate.")
+            return
         logging.debug("Geolocating IPs and building location dictionary.")
 
-        def chunks_(l, n):
-            """
-            Prepare chunks for use within IP list slice.
+        index = self._load_geo_index() if app_settings['geo_index'] == 1 else None
+        if index is not None:
+            self._build_locations_indexed(index, ip_list)
+        else:
+            self._build_locations_pooled(ip_list)
 
-            :param l: IP list.
-            :param n: Chunk size based on CPUs.
-            :return: Chunked slice.
-            """
+    @staticmethod
+    def record_hits(ip_list, hit_counts, accumulate):
+        """
+        Record how many times each IP occurred within the log files, so forecasts can be prioritized, and histograms
+        weighted, by traffic.
+
+        :param ip_list: Array of IP addresses as unsigned 32-bit integers.
+        :param hit_counts: Array of each IP's occurrence count, aligned with the IP list.
+        :param accumulate: Whether to add the counts to each location's hits, as when only lines appended since the
+        previous run were parsed, or replace them, as when the log files were parsed in full.
+        """
 
-            # Not the world's ugliest list comprehension, but deserves an honorable mention
-            return [l[_:_ + n] for _ in range(0, len(l), n)]
+        sql = 'UPDATE locations SET hits = {} WHERE ip = ?'.format('hits + ?' if accumulate else '?')
+        with LocationWriter(sql, sort_key=itemgetter(1)) as writer:
+            writer.write_many_([(count, ip_to_str(ip)) for ip, count in zip(ip_list.tolist(), hit_counts.tolist())])
+        logging.info(
+            "{} {} hits for {} locations."
+            .format("Added" if accumulate else "Recorded", int(hit_counts.sum()), writer.written))
+
+    @staticmethod
+    def _load_geo_index():
+        """
+        Load the geolocation reference database's network range index, compiling it if needed.
+
+        :return: `GeoIndex`, or None if it couldn't be compiled.
+        """
 
-        # Slice IP list and multiprocess them
-        logging.debug("Building location entries from IP list.")
+        try:
+            return GeoIndex.load(app_settings['geodb_filename'])
+        except (AttributeError, KeyError, TypeError, ValueError, maxminddb.InvalidDatabaseError) as e:
+            logging.warning("Unable to compile geolocation index, falling back to database reader: {}".format(e))
+            return None
+
+    @staticmethod
+    def _build_locations_indexed(index, ip_list):
+        """
+        Geolocate IPs in bulk against the geolocation reference database's network range index.
+
+        :param index: `GeoIndex`.
+        :param ip_list: Sorted array of IP addresses as unsigned 32-bit integers.
+        """
+
+        ip_epoch = datetime.datetime.now().strftime('%s')  # Epoch when location was written
+        found, places = index.lookup(ip_list)
+        place_rows = {}  # Place table index to place columns, as many IPs share a place
+        with LocationWriter(INSERT_LOCATION_SQL) as writer:
+            for ip, found_, place in zip(ip_list.tolist(), found.tolist(), places.tolist()):
+                if found_:
+                    if place not in place_rows:
+                        place_rows[place] = index.place(place)
+                    writer.write_(ip_to_str(ip), ip_epoch, 1, *place_rows[place], 0.0, 0)
+                else:
+                    writer.write_(ip_to_str(ip), ip_epoch, 0, 0.0, 0.0, "", "", "", 0.0, 0)
+        logging.info(
+            "Geolocated {} of {} IPs using the geolocation index.".format(int(found.sum()), len(ip_list)))
+        logging.info("Populated location database table with {} IP locations.".format(writer.written))
+
+    @staticmethod
+    def _load_network_cache(build_epoch):
+        """
+        Load the network geolocation cache, first dropping networks cached from a different geolocation reference
+        database build.
+
+        :param build_epoch: Geolocation reference database build epoch.
+        :return: `NetworkCache`.
+        """
+
+        db = LocationDB()
+        db.update_('DELETE FROM geo_cache WHERE build_epoch != ?', build_epoch)
+        cache = NetworkCache(db.select_(
+            'SELECT network_start, network_end, latitude, longitude, city, region, country FROM geo_cache'))
+        logging.debug("Loaded network geolocation cache of {} networks.".format(len(cache)))
+        return cache
+
+    @staticmethod
+    def _evict_network_cache():
+        """
+        Evict least recently used networks beyond `geo_cache_size` from the network geolocation cache.
+        """
+
+        LocationDB().update_(
+            'DELETE FROM geo_cache WHERE network_start NOT IN '
+            '(SELECT network_start FROM geo_cache ORDER BY last_used DESC LIMIT ?)', app_settings['geo_cache_size'])
+
+    def _build_locations_pooled(self, ip_list):
+        """
+        Geolocate IPs using a pool of processes, each with its own geolocation reference database reader. The
+        geolocation reference database is looked up once per network, and networks are kept within the network
+        geolocation cache across runs.
+
+        :param ip_list: Sorted array of IP addresses as unsigned 32-bit integers.
+        """
+
+        use_cache = app_settings['geo_cache_size'] > 0
+        build_epoch = self.reader.metadata().build_epoch
+        cache = self._load_network_cache(build_epoch) if use_cache else NetworkCache()
+        last_used = int(time.time())
+        used = set()
+        networks = 0
+
+        # Hand out small IP list batches to a pool of processes, which pull a new batch as soon as they're done
         try:
             cpu_count = multiprocessing.cpu_count()
-            logging.debug("Got system CPU count of {}. Starting {} processes.".format(cpu_count, cpu_count))
         except NotImplementedError:
             cpu_count = 1
             logging.warning("Unable to dynamically ascertain system CPU count. Assuming one.")
-        chunk_size = round(len(ip_list) / cpu_count)
-        slice_ = chunks_(ip_list, int(chunk_size))
-        process_list = []
-        for i, list_slice in enumerate(slice_):
-            process = multiprocessing.Process(target=self._process_ip_list_slice, args=(i, list_slice))
-            process_list.append(process)
-        for process in process_list:
-            process.start()
-        for process in process_list:
-            process.join()
-        logging.info("Populated location database table with geolocated IPs.")
+        batches = [ip_list[i:i + GEOLOCATION_BATCH_SIZE] for i in range(0, len(ip_list), GEOLOCATION_BATCH_SIZE)]
+        processes = min(cpu_count, len(batches))
+        logging.debug("Starting {} processes to geolocate {} IP list batches.".format(processes, len(batches)))
+        with multiprocessing.Pool(
+                processes, initializer=_init_geolocation_process,
+                initargs=(app_settings['geodb_filename'], cache)) as pool:
+            # Write locations as they arrive, as this (parent) process is the location database's single writer
+            with LocationWriter(INSERT_LOCATION_SQL) as writer, LocationWriter(INSERT_GEO_CACHE_SQL) as cache_writer:
+                try:
+                    for rows, new_networks, used_networks in pool.imap_unordered(_geolocate_ip_batch, batches):
+                        writer.write_many_(rows)
+                        networks += len(new_networks)
+                        if use_cache:
+                            cache_writer.write_many_(
+                                [network + (build_epoch, last_used) for network in new_networks])
+                            used.update(used_networks)
+                except AttributeError:
+                    # This is not likely to happen, but should 'geodb' object fail, handle it
+                    raise GracefulException(
+                        "Geolocation reference database object is invalid! Database was either not found previously, "
+                        "and exception handling failed, or the database is no longer locked to us.")
+            # Let processes exit, rather than terminating them, so they finish queueing their logging
+            pool.close()
+            pool.join()
+        logging.info("Populated location database table with {} IP locations.".format(writer.written))
+        logging.info(
+            "Looked up {} networks in the geolocation reference database, and reused {} cached networks."
+            .format(networks, len(used)))
+
+        if use_cache:
+            with LocationWriter(TOUCH_GEO_CACHE_SQL) as touch_writer:
+                touch_writer.write_many_([(last_used, start) for start in used])
+            self._evict_network_cache()
+
+
+class LocationWriter(object):
+    """
+    Single long-lived location database connection, which buffers rows and writes them using `executemany` within
+    large transactions. Meant to be used as a context manager, which writes any remaining rows on exit.
+    """
+
+    def __init__(self, sql, batch_size=WRITE_BATCH_SIZE, sort_key=None, flush_interval=None):
+        """
+
+        :param sql: Parameterized SQL statement executed for every row.
+        :param batch_size: Rows buffered before they're written within a single transaction.
+        :param sort_key: Optional function buffered rows are sorted by before they're written, e.g. the key an `UPDATE`
+        looks rows up by, so the table's B-tree is walked in order rather than at random.
+        :param flush_interval: Optional most seconds rows are buffered before they're written, bounding what's lost
+        should the application crash.
+        """
+        self.db_file = app_settings['location_db']
+        self.sql = sql
+        self.batch_size = batch_size
+        self.sort_key = sort_key
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.rows = []
+        self.written = 0
+        self.connection = None
+
+    def __enter__(self):
+        try:
+            self.connection = sqlite3.connect(self.db_file)
+            self.connection.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer, and vice versa
+            self.connection.execute('PRAGMA synchronous=NORMAL')  # WAL is still durable across application crashes
+        except sqlite3.OperationalError as e:
+            logging.error("Locations database exception: {}".format(e))
+            raise GracefulException("Unable to open location database for writing!")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        try:
+            self.flush_()
+        finally:
+            self.connection.close()
+
+    def write_(self, *args):
+        """
+        Buffer a row, and write the buffer when full.
+
+        :param args: Table values vars.
+        """
+
+        self.rows.append(args)
+        if self._full():
+            self.flush_()
+
+    def write_many_(self, rows):
+        """
+        Buffer rows, and write the buffer when full.
+
+        :param rows: List of table values tuples.
+        """
+
+        self.rows.extend(rows)
+        if self._full():
+            self.flush_()
+
+    def _full(self):
+        """
+        Whether the buffer is full, or has been buffering for longer than the flush interval.
+
+        :return: Boolean.
+        """
+
+        return len(self.rows) >= self.batch_size or (
+            self.flush_interval is not None and time.monotonic() - self.flushed >= self.flush_interval)
+
+    def flush_(self):
+        """
+        Write buffered rows within a single transaction.
+        """
+
+        self.flushed = time.monotonic()
+        if not self.rows:
+            return
+        if self.sort_key is not None:
+            self.rows.sort(key=self.sort_key)
+        try:
+            with self.connection:
+                self.connection.executemany(self.sql, self.rows)
+        except sqlite3.Error as e:
+            logging.error("Locations database exception: {}".format(e))
+            raise GracefulException("Locations database failure!")
+        self.written += len(self.rows)
+        logging.debug("Wrote {} rows to location database.".format(len(self.rows)))
+        self.rows = []
 
 
 class LocationDB(object):  # TODO: Consolidate exception handling
@@ -145,7 +470,8 @@ class LocationDB(object):  # TODO: Consolidate exception handling
 
     def initialize_(self):
         """
-        Initialize location database and 'locations' table.
+        Initialize location database, and its 'locations', 'geo_cache', 'forecast_cache', 'forecast_failures', and
+        'log_checkpoints' tables.
         """
 
         try:
@@ -163,28 +489,89 @@ class LocationDB(object):  # TODO: Consolidate exception handling
                     forecast_temperature REAL, forecast_epoch INTEGER 
                     )
                     ''')
+                # Log occurrences of each IP, added after the table was first released
+                columns = [row[1] for row in cursor.execute('PRAGMA table_info(locations)')]
+                if 'hits' not in columns:
+                    cursor.execute('ALTER TABLE locations ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+                # Stale forecast query. Not a covering index, as forecast updates would then rewrite far more of it
+                cursor.execute('CREATE INDEX IF NOT EXISTS locations_forecast_epoch ON locations (forecast_epoch)')
+                cursor.execute(
+                    '''
+                    CREATE TABLE IF NOT EXISTS geo_cache (
+                    network_start INTEGER PRIMARY KEY, network_end INTEGER,
+                    latitude REAL, longitude REAL, city TEXT, region TEXT, country TEXT,
+                    build_epoch INTEGER, last_used INTEGER
+                    )
+                    ''')
+                cursor.execute(
+                    '''
+                    CREATE TABLE IF NOT EXISTS forecast_cache (
+                    cell_latitude REAL, cell_longitude REAL, forecast_day INTEGER,
+                    forecast_temperature REAL, forecast_epoch INTEGER, response_epoch INTEGER,
+                    PRIMARY KEY (cell_latitude, cell_longitude, forecast_day)
+                    )
+                    ''')
+                cursor.execute(
+                    '''
+                    CREATE TABLE IF NOT EXISTS forecast_failures (
+                    cell_latitude REAL, cell_longitude REAL, forecast_day INTEGER,
+                    attempts INTEGER, retryable INTEGER, reason TEXT, failure_epoch INTEGER,
+                    PRIMARY KEY (cell_latitude, cell_longitude, forecast_day)
+                    )
+                    ''')
+                cursor.execute(
+                    '''
+                    CREATE TABLE IF NOT EXISTS log_checkpoints (
+                    device INTEGER, inode INTEGER, path TEXT, size INTEGER, head_length INTEGER, head_hash TEXT,
+                    offset INTEGER, checkpoint_epoch INTEGER,
+                    PRIMARY KEY (device, inode)
+                    )
+                    ''')
                 connection.commit()
         except sqlite3.OperationalError as e:
             logging.error("Locations database exception: {}".format(e))
             raise GracefulException("Unable to setup location database!")
 
-    def select_(self, sql):
+    def select_(self, sql, *args):
         """
         Read (fetch) row from table.
         :param sql: SQL query.
+        :param args: Query parameter vars.
         :return: Table rows matching query.
         """
 
         try:
             with sqlite3.connect(self.db_file) as connection:
                 cursor = connection.cursor()
-                cursor.execute('{}'.format(sql))
+                cursor.execute('{}'.format(sql), args)
                 rows = cursor.fetchall()
                 return rows
         except sqlite3.OperationalError as e:
             logging.error("Locations database exception: {}".format(e))
             raise GracefulException("Locations database failure!")
 
+    def select_chunks_(self, sql, *args, size=READ_BATCH_SIZE):
+        """
+        Read (fetch) rows from table in chunks, so a query's rows are streamed rather than all held at once.
+
+        :param sql: SQL query.
+        :param args: Query parameter vars.
+        :param size: Most rows per chunk.
+        :return: Generator of lists of table rows matching query.
+        """
+
+        try:
+            with sqlite3.connect(self.db_file) as connection:
+                cursor = connection.cursor()
+                cursor.execute('{}'.format(sql), args)
+                rows = cursor.fetchmany(size)
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(size)
+        except sqlite3.OperationalError as e:
+            logging.error("Locations database exception: {}".format(e))
+            raise GracefulException("Locations database failure!")
+
     def insert_(self, sql, *args):
         """
         Write (insert) row to table.
@@ -198,27 +585,52 @@ class LocationDB(object):  # TODO: Consolidate exception handling
                 cursor = connection.cursor()
                 cursor.execute('{}'.format(sql), args)
                 connection.commit()
-        except sqlite3.IntegrityError or sqlite3.ProgrammingError or sqlite3.OperationalError as e:
+        except (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.OperationalError) as e:
             logging.error("Locations database exception: {}".format(e))
             raise GracefulException("Locations database failure!")
 
-    def update_(self, sql):
+    def update_(self, sql, *args):
         """
         Update row in table.
 
         :param sql: SQL statement.
+        :param args: Statement parameter vars.
         """
 
         try:
             with sqlite3.connect(self.db_file) as connection:
                 cursor = connection.cursor()
-                cursor.execute('{}'.format(sql))
+                cursor.execute('{}'.format(sql), args)
                 connection.commit()
-        except sqlite3.IntegrityError or sqlite3.ProgrammingError or sqlite3.OperationalError as e:
+        except (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.OperationalError) as e:
             logging.error("Locations database exception: {}".format(e))
             raise GracefulException("Locations database failure!")
 
 
+def ip_to_str(address):
+    """
+    Format IPv4 host address as a dotted quad.
+
+    :param address: IPv4 host address as an integer.
+    :return: Dotted quad string, e.g. '8.8.8.8'.
+    """
+
+    address = int(address)
+    return '{}.{}.{}.{}'.format(address >> 24, address >> 16 & 255, address >> 8 & 255, address & 255)
+
+
+def ip_to_int(ip):
+    """
+    Parse dotted quad IPv4 host address.
+
+    :param ip: Dotted quad string, e.g. '8.8.8.8'.
+    :return: IPv4 host address as an integer.
+    """
+
+    a, b, c, d = ip.split('.')
+    return int(a) << 24 | int(b) << 16 | int(c) << 8 | int(d)
+
+
 def gen_epoch(days_offset):
     """
     Provides epoch for a given day.
@@ -2,7 +2,22 @@
 Exercise handlers.
 """
 
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import random
+import sys
+
+# Argument types passed through the logging queue as they are, so their messages are only formatted when written
+LAZY_ARG_TYPES = (str, bytes, int, float, bool, type(None))
+
+# Number of log records queued at once
+LOG_BATCH_SIZE = 1000
+
+# Seconds to wait for the logging queue listener to handle another record batch when exiting
+LISTENER_STOP_TIMEOUT = 10
 
 
 class GracefulException(Exception):
@@ -15,3 +30,181 @@ class GracefulException(Exception):
         logging.error(message)
         logging.fatal("Application can't continue!")
         exit(-1)
+
+
+class DebugSampler(object):
+    """
+    Samples the DEBUG records of hot loops, e.g. per log line, or per IP, deciding before a record is made, so DEBUG
+    logging can be kept on at a fraction of its cost.
+    """
+
+    def __init__(self, rate=1.0):
+        """
+
+        :param rate: Proportion of hot loop DEBUG records logged, e.g. 0.01 for 1%.
+        """
+        self.rate = rate
+
+    def sample(self):
+        """
+        Whether to log a hot loop's DEBUG record.
+
+        :return: True if DEBUG logging is enabled, and the record is sampled.
+        """
+
+        return logging.root.isEnabledFor(logging.DEBUG) and random.random() < self.rate
+
+
+debug_sampler = DebugSampler()
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that hands records to the queue listener unformatted, so messages are formatted by the listener's
+    thread, rather than by the logging caller. Records' exception information is formatted up front, and arguments
+    that may not pickle across processes are merged into the message, as `QueueHandler` does.
+
+    Records are queued in batches, rather than one by one, as queueing across processes costs far more per put than
+    per record. A batch is queued once full, as soon as it holds an INFO or higher record, or when flushed.
+    """
+
+    def __init__(self, queue, capacity=LOG_BATCH_SIZE):
+        """
+
+        :param queue: Queue, shared with the `BatchQueueListener`.
+        :param capacity: Number of records per batch.
+        """
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.capacity = capacity
+        self.buffer = []
+        # Queue the batch before forking, so a forked process doesn't inherit, and queue, a copy of it
+        os.register_at_fork(before=self.flush, after_in_child=self.buffer.clear)
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        if not isinstance(record.msg, str) or not all(isinstance(arg, LAZY_ARG_TYPES) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.prepare(record))
+            if len(self.buffer) >= self.capacity or record.levelno > logging.DEBUG:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.enqueue(self.buffer[:])
+                self.buffer.clear()
+        finally:
+            self.release()
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    """
+    Queue listener handling the record batches queued by `LazyQueueHandler`.
+    """
+
+    batches = 0  # Record batches handled
+
+    def handle(self, records):
+        for record in records:
+            logging.handlers.QueueListener.handle(self, record)
+        self.batches += 1
+
+    def stop(self, timeout=LISTENER_STOP_TIMEOUT):
+        """
+        Stop the listener, once it has handled the records already queued, waiting for as long as it keeps handling
+        them. A process killed part way through queueing a batch leaves the listener waiting on the rest of it, so once
+        the listener has handled nothing for `timeout` seconds, it's abandoned, rather than holding up the application's
+        exit.
+
+        :param timeout: Seconds to wait for the listener to handle another batch.
+        """
+
+        self.enqueue_sentinel()
+        batches = None
+        while self._thread.is_alive() and self.batches != batches:
+            batches = self.batches
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.queue.cancel_join_thread()  # Don't wait on the queue's unread data when exiting either
+            sys.stderr.write("[TemperatureHistogram] Logging queue listener didn't stop. Some log records are lost.\n")
+        self._thread = None
+
+
+def flush_logging():
+    """
+    Queue the records batched by this process' logging handlers. Called at the end of `multiprocessing` tasks, as pool
+    processes exit without flushing.
+    """
+
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
+def _skip_unused_record_attributes(formatter):
+    """
+    Stop collecting log record attributes the log format doesn't use, as the logging HOWTO's "Optimization" section
+    suggests.
+
+    :param formatter: Log record format.
+    """
+
+    # `logging._srcfile` is private, but is the only way to skip `findCaller`, which walks the stack for every record to
+    # find the caller's source file, line, and function. Only skipped when the log format doesn't use them.
+    if not any(field in formatter for field in ('%(pathname)', '%(filename)', '%(module)', '%(lineno)', '%(funcName)')):
+        logging._srcfile = None
+    logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False
+
+
+def setup_logging(formatter, filename):
+    """
+    Route logging through a queue to a background listener thread, which writes DEBUG records to a file, and INFO
+    records to the console. The queue is a `multiprocessing` queue, so processes forked afterwards, e.g. by
+    `multiprocessing.Pool`, log through it too, rather than writing to the file themselves. The listener is stopped,
+    writing any queued records, when the application exits.
+
+    Record attributes the log format doesn't use, i.e. the caller's source file, and the thread and process, aren't
+    collected.
+
+    :param formatter: Log record format.
+    :param filename: DEBUG log filename.
+    :return: `BatchQueueListener`.
+    """
+
+    # File (DEBUG) handler
+    file_handler = logging.FileHandler(filename, mode='w')
+    file_handler.setFormatter(logging.Formatter(formatter))
+    file_handler.setLevel(logging.DEBUG)
+
+    # Console (INFO) handler
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(formatter))
+    console_handler.setLevel(logging.INFO)
+
+    # Logger, and queue handler
+    queue = multiprocessing.Queue(-1)
+    queue_handler = LazyQueueHandler(queue)
+    _skip_unused_record_attributes(formatter)
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(queue_handler)
+
+    listener = BatchQueueListener(queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        queue_handler.flush()
+        listener.stop()
+
+    atexit.register(stop)
+    return listener
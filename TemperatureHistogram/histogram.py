@@ -2,66 +2,244 @@
 Exercise histogram module.
 """
 
+import io
 import logging
+import struct
+
 import numpy as np
 
 from TemperatureHistogram.handlers import GracefulException
 from TemperatureHistogram.settings import app_settings
+from TemperatureHistogram.sinks import HistogramResult, build_sinks
+from TemperatureHistogram.summary import HistogramSummary
 
 
 class Histogram(object):
     """
-    Build, save, and display a histogram produced using a list of temperatures.
+    Build, and output a histogram of temperatures, accumulated chunk by chunk into fixed bucket edges, so the
+    temperatures are never all held at once. Counts are kept within a mergeable `HistogramSummary`, along with a
+    quantile sketch for percentiles, so histograms of separate runs can be merged.
     """
 
-    def __init__(self, temperature_list):
+    def __init__(self, temperature_range=None, sample=None, summary=None, group_by=None):
         """
 
-        :param temperature_list: List of temperatures.
+        :param temperature_range: Lowest, and highest temperature, to derive `buckets` equal width bucket edges from,
+        unless `bucket_edges` are configured.
+        :param sample: `StratifiedSample` the temperatures are sampled by, to estimate bucket counts of the whole
+        population with margins of error, or None when the temperatures are the whole population.
+        :param summary: `HistogramSummary` already accumulated, e.g. merged from separate runs, or None to start empty.
+        :param group_by: Name of the group temperatures are labeled with, e.g. 'country', to count every group within
+        the same bucket edges, or None to count all temperatures together.
         """
-        self.temperature_list = temperature_list
-        self.bins = app_settings['buckets']
+        if summary is None:
+            edges = app_settings['bucket_edges']
+            if edges is None:
+                if temperature_range is None or None in temperature_range:
+                    raise GracefulException("Unable to build location temperature histogram! No fresh temperatures.")
+                # Equal width buckets spanning the temperatures, as NumPy's `histogram` derives them
+                edges = np.histogram_bin_edges(np.empty(0), bins=app_settings['buckets'], range=temperature_range)
+            summary = HistogramSummary(edges, app_settings['sketch_accuracy'])
+        self.summary = summary
+        self.bins = summary.bins
+        self.sample = sample
         self.tsv_file = app_settings['tsv_output']
+        if sample is not None:
+            strata_count = len(sample.population_sizes)
+            self.sample_sizes = np.zeros(strata_count)
+            self.sample_sums = np.zeros((strata_count, self.bins))
+            self.sample_squares = np.zeros((strata_count, self.bins))
+        self.group_by = group_by
+        self.group_labels = []
+        self.group_indexes = {}  # Group label to its row within group counts
+        self.group_counts = np.zeros((0, self.bins))
         self.histogram_array = None
 
-        if not temperature_list:
-            raise GracefulException("Unable to build location temperature list! List was empty.")
+    @classmethod
+    def merged(cls, filenames):
+        """
+        Merge histogram summaries saved by separate runs, e.g. one per log source or host.
+
+        :param filenames: List of histogram summary filenames.
+        :return: `Histogram` of the merged summary.
+        """
+
+        summary = None
+        for filename in filenames:
+            try:
+                shard = HistogramSummary.load(filename)
+                summary = shard if summary is None else summary.merge(shard)
+            except (OSError, ValueError, struct.error) as e:
+                raise GracefulException("Unable to merge histogram summary '{}': {}".format(filename, e))
+            logging.info("Merged histogram summary '{}' of {} temperature(s).".format(filename, shard.temperatures))
+        if summary is None:
+            raise GracefulException("No histogram summaries to merge!")
+        if summary.approximate:
+            logging.warning(
+                "Histogram summaries' bucket edges differ, so bucket counts were re-binned from their quantile sketch, "
+                "within {}% of each bucket edge.".format(summary.sketch.accuracy * 100))
+        return cls(summary=summary)
+
+    def accumulate(self, temperatures, weights=None, strata=None, groups=None):
+        """
+        Add a chunk of temperatures into their buckets.
+
+        :param temperatures: Array of temperatures, NaN when null.
+        :param weights: Array of each temperature's weight, e.g. its location's hits, or None to count each once.
+        :param strata: Array of each temperature's sample stratum index, when the histogram is estimated from a sample.
+        :param groups: Array of each temperature's group label, when grouped.
+        """
+
+        buckets, inside = self.summary.add(temperatures, weights)
+        if self.group_by is not None:
+            self._accumulate_groups(groups, buckets[inside], None if weights is None else weights[inside], inside)
+        if self.sample is not None:
+            nulls = np.isnan(temperatures)
+            weights = np.ones(len(temperatures)) if weights is None else weights
+            strata_count = len(self.sample_sizes)
+            cells = strata[inside] * self.bins + buckets[inside]  # Flattened stratum, bucket index
+            self.sample_sizes += np.bincount(strata[~nulls], minlength=strata_count)
+            self.sample_sums += np.bincount(
+                cells, weights=weights[inside], minlength=self.sample_sums.size).reshape(strata_count, self.bins)
+            self.sample_squares += np.bincount(
+                cells, weights=weights[inside] ** 2, minlength=self.sample_sums.size).reshape(strata_count, self.bins)
+
+    def _accumulate_groups(self, groups, buckets, weights, inside):
+        """
+        Add a chunk of temperatures into their group's buckets, for every group at once. Only the chunk's distinct
+        group labels are looked up, so the cost hardly depends on the number of groups.
+
+        :param groups: Array of each temperature's group label.
+        :param buckets: Array of bucket indexes, of temperatures within a bucket.
+        :param weights: Array of weights, of temperatures within a bucket, or None to count each once.
+        :param inside: Boolean array of whether each temperature is within a bucket.
+        """
+
+        labels, label_indexes = np.unique(groups[inside], return_inverse=True)
+        new_labels = [label for label in labels.tolist() if label not in self.group_indexes]
+        for label in new_labels:
+            self.group_indexes[label] = len(self.group_labels)
+            self.group_labels.append(label)
+        if new_labels:
+            self.group_counts = np.vstack([self.group_counts, np.zeros((len(new_labels), self.bins))])
+        group_indexes = np.array([self.group_indexes[label] for label in labels.tolist()], dtype=np.intp)
+        cells = group_indexes[label_indexes] * self.bins + buckets  # Flattened group, bucket index
+        self.group_counts += np.bincount(
+            cells, weights=weights, minlength=self.group_counts.size).reshape(self.group_counts.shape)
 
     def build_histogram(self):
         """
         Build histogram array needed for NumPy's `savetxt`.
         """
-        a = np.array(self.temperature_list)  # Convert temperature list into numpy array
-        freqs, bins = np.histogram(a, bins=self.bins)  # Produce histogram
-        self.histogram_array = np.array(list(zip(bins[:-1], bins[1:] - 1, freqs)))  # "array_like" for `savetxt`
+        summary = self.summary
+        if summary.nulls:
+            logging.warning("Skipped {} location(s) with a null forecast temperature.".format(summary.nulls))
+        if summary.outside:
+            logging.warning(
+                "Skipped {} location(s) with a temperature outside the bucket edges.".format(summary.outside))
+        if not summary.temperatures:
+            raise GracefulException("Unable to build location temperature histogram! No fresh temperatures.")
+        logging.info("Accumulated {} location temperature(s) into {} buckets.".format(summary.temperatures, self.bins))
+        edges = summary.edges
+        if self.group_by is not None:
+            logging.info("Counted {} {} group(s) within the same bucket edges.".format(
+                len(self.group_labels), self.group_by))
+            order = np.argsort(self.group_labels)  # Groups sorted by label, each with all of its buckets
+            self.histogram_array = np.array([
+                (self.group_labels[group], low, high, count) for group in order.tolist()
+                for low, high, count in zip(edges[:-1], edges[1:] - 1, self.group_counts[group])], dtype=object)
+            return
+        if self.sample is None:  # "array_like" for `savetxt`
+            # Counts re-binned from a merged quantile sketch are fractional
+            self.histogram_array = np.array(list(zip(edges[:-1], edges[1:] - 1, np.round(summary.counts))))
+            return
 
-    def display_histogram(self):
+        missing = self.sample_sizes == 0
+        if missing.any():
+            logging.warning(
+                "Leaving {} location(s) of strata without a sampled fresh forecast out of the estimate."
+                .format(int(self.sample.population_sizes[missing].sum())))
+        estimates, margins = self.sample.estimate(self.sample_sizes, self.sample_sums, self.sample_squares)
+        self.histogram_array = np.array(list(zip(edges[:-1], edges[1:] - 1, np.round(estimates), np.round(margins))))
+
+    def render(self):
         """
-        Display previously saved histogram file.
+        Render histogram once, in memory, as tab delimited text, and as columns, for every output sink.
+
+        :return: `HistogramResult`.
         """
-        try:
-            with open(self.tsv_file, 'rt') as f:
-                logging.info("Histogram tsv file as saved:\n" + str(f.read()))
-        except FileNotFoundError:
-            raise GracefulException(
-                "File '{}' was not found! Couldn't display histogram results.".format(self.tsv_file))
+        comments = "Exercise tsv content with a bucket count of {}:\n\n".format(self.bins)
+        columns = ["bucketMin", "bucketMax", "count"]
+        fmt = ['%.2f\t', '%.2f\t', '%d']
+        if self.sample is not None:
+            # Estimated counts, plus or minus their margin of error
+            comments = "Exercise tsv content with a bucket count of {}, estimated at {}% confidence:\n\n".format(
+                self.bins, self.sample.confidence)
+            columns.append("countMargin")
+            fmt = ['%.2f\t', '%.2f\t', '%d\t', '%d']
+        if self.group_by is not None:
+            comments = "Exercise tsv content with a bucket count of {}, per {}:\n\n".format(self.bins, self.group_by)
+            columns.insert(0, self.group_by)
+            fmt = ['%s\t'] + fmt
+        text = io.StringIO()
+        np.savetxt(
+            text,
+            X=self.histogram_array,
+            comments=comments,
+            header='\t'.join(columns),
+            fmt=fmt,
+            delimiter='\t',
+            newline='\r\n')
+
+        values = [
+            self.histogram_array[:, i].astype(str if column == self.group_by else np.float64)
+            for i, column in enumerate(columns)]
+        values = [
+            np.round(column).astype(np.int64) if name in ("count", "countMargin") else column
+            for name, column in zip(columns, values)]
+        percentiles = app_settings['histogram_percentiles']
+        metadata = {
+            'bucketCount': self.bins, 'groupBy': self.group_by,
+            'confidence': None if self.sample is None else self.sample.confidence,
+            'approximate': bool(self.summary.approximate)}
+        return HistogramResult(
+            columns, values, text.getvalue(), list(zip(percentiles, self.summary.percentiles(percentiles))), metadata)
 
     def save_histogram(self):
         """
-        Save histogram as a tab delimited file.
+        Render histogram once, and output it to every sink of `histogram_outputs`, e.g. a tab delimited file, and the
+        log. Files are replaced atomically, so readers never see a partial histogram.
+        """
+        result = self.render()
+        for sink in build_sinks(app_settings['histogram_outputs'], self.tsv_file):
+            try:
+                sink.write_(result)
+            except OSError:
+                raise GracefulException("Could not save histogram to '{}'".format(sink.filename))
+            if sink.filename is not None:
+                logging.info("Completed producing and saving histogram to '{}'.".format(sink.filename))
+
+    def display_percentiles(self):
+        """
+        Display temperature percentiles estimated from the histogram summary's quantile sketch.
+        """
+        percentiles = app_settings['histogram_percentiles']
+        temperatures = self.summary.percentiles(percentiles)
+        logging.info("Temperature percentiles, within {}%{}: {}".format(
+            self.summary.sketch.accuracy * 100, " of the sampled locations" if self.sample is not None else "",
+            ", ".join("p{:g} {:.2f}".format(p, t) for p, t in zip(percentiles, temperatures) if t is not None)))
+
+    def save_summary(self, filename):
+        """
+        Save the histogram summary, for merging with those of separate runs.
+
+        :param filename: Histogram summary filename.
         """
+        if self.sample is not None:
+            logging.warning("Not saving histogram summary, as histograms estimated from a sample can't be merged.")
+            return
         try:
-            np.savetxt(  # Save histogram and display it
-                fname=self.tsv_file,
-                X=self.histogram_array,
-                comments="Exercise tsv content with a bucket count of {}:\n\n".format(self.bins),
-                header='{}\t{}\t{}'.format("bucketMin", "bucketMax", "count"),
-                fmt=['%.2f\t', '%.2f\t', '%d'],
-                delimiter='\t',
-                newline='\r\n')
-            logging.info("Completed producing and saving histogram to '{}'.".format(self.tsv_file))
+            self.summary.save_(filename)
+            logging.info("Completed saving histogram summary to '{}'.".format(filename))
         except OSError:
-            """
-            If we can't save the histogram, handle exception, but after `FileNotFoundError` subclass to avoid ambiguity."
-            """
-            raise GracefulException("Could not save histogram to '{}'".format(self.tsv_file))
+            raise GracefulException("Could not save histogram summary to '{}'".format(filename))
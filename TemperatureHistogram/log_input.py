@@ -2,111 +2,774 @@
 Exercise log input module.
 """
 
-from ipaddress import AddressValueError, ip_address
+from array import array
+from bisect import bisect_right
+import bz2
+import glob
+import gzip
+from ipaddress import ip_address, ip_network
+import hashlib
 import logging
+import lzma
+import mmap
+import multiprocessing
+import os
 import re
+import time
+import zlib
 
-from TemperatureHistogram.handlers import GracefulException
+import numpy as np
+
+from TemperatureHistogram.geolocation import LocationDB, ip_to_str
+from TemperatureHistogram.handlers import GracefulException, debug_sampler, flush_logging
 from TemperatureHistogram.settings import app_settings
 
+IP_PATTERN = re.compile(rb'[0-9]+(?:\.[0-9]+){3}')  # Candidate IPv4 host address, matched against raw bytes
+CHUNK_SIZE = 64 * 1024 * 1024  # Bytes scanned per chunk. Chunks are extended to end on a newline
+MIN_RANGE_SIZE = 4 * 1024 * 1024  # Smallest byte range worth handing to a parse worker process
+COMPACT_SIZE = 8 * 1024 * 1024  # Buffered IP occurrences before they're compacted into unique IPs and counts
+HEAD_SIZE = 4096  # Leading bytes hashed to recognize a log file across runs
+VERDICT_CACHE_SIZE = 65536  # Memoized classify_ip() results kept, at most, before they're cleared
+DECOMPRESSORS = ((b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open))  # Magic bytes, opener
+
+NOT_GLOBAL = -1  # Verdict for valid, but special purpose, IPv4 host addresses
+INVALID = -2  # Verdict for candidates that aren't IPv4 host addresses
+
+# IANA IPv4 Special-Purpose Address Registry, plus shared and multicast address space. Only the network boundaries are
+# used, as whether a range is global is settled by the `ipaddress` library itself when building the range table
+SPECIAL_PURPOSE_NETWORKS = (
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12', '192.0.0.0/24',
+    '192.0.0.0/29', '192.0.0.8/32', '192.0.0.9/32', '192.0.0.10/32', '192.0.0.170/31', '192.0.2.0/24',
+    '192.31.196.0/24', '192.52.193.0/24', '192.88.99.0/24', '192.168.0.0/16', '192.175.48.0/24', '198.18.0.0/15',
+    '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4', '255.255.255.255/32')
+
+
+def _build_range_table():
+    """
+    Build sorted table of IPv4 range start addresses, and whether the range starting at each one is global.
+
+    Every address between two neighbouring network boundaries shares the verdict of the first, so `is_global` only
+    needs asking once per range. Neighbouring ranges with the same verdict are merged.
+
+    :return: List of range start addresses as integers, and list of respective verdicts.
+    """
+
+    boundaries = {0}
+    for network in SPECIAL_PURPOSE_NETWORKS:
+        network = ip_network(network)
+        boundaries.add(int(network.network_address))
+        boundaries.add(int(network.broadcast_address) + 1)
+    boundaries.discard(2 ** 32)
+    starts, verdicts = [], []
+    for start in sorted(boundaries):
+        verdict = ip_address(start).is_global
+        if not verdicts or verdicts[-1] != verdict:
+            starts.append(start)
+            verdicts.append(verdict)
+    return starts, verdicts
+
+
+def _leading_zeros_allowed():
+    """
+    Whether `ipaddress` accepts octets with leading zeros, which changed in Python 3.9.5.
+
+    :return: True if octets such as '01' are accepted, otherwise False.
+    """
+
+    try:
+        ip_address('01.2.3.4')
+        return True
+    except ValueError:
+        return False
+
+
+_range_starts, _range_global = _build_range_table()
+_leading_zeros = _leading_zeros_allowed()
+_verdicts = {}  # Memoized classify_ip() results, keyed by candidate IP bytes
+
+
+def classify_ip(ip):
+    """
+    Classify candidate IPv4 host address by parsing it to a 32-bit integer, and looking up the special purpose range
+    table. Results are memoized, so repeated IPs cost a single dictionary lookup. The memo is cleared whenever it
+    reaches `VERDICT_CACHE_SIZE` entries, so it never holds every distinct candidate of a large log.
+
+    Verdicts match `ipaddress.ip_address(ip).is_global`.
+
+    :param ip: IPv4 host address as dotted quad bytes, e.g. b'8.8.8.8'.
+    :return: Integer address if public, `NOT_GLOBAL` if special purpose, or `INVALID` if not an IPv4 host address.
+    """
+
+    try:
+        return _verdicts[ip]
+    except KeyError:
+        pass
+    if len(_verdicts) >= VERDICT_CACHE_SIZE:
+        _verdicts.clear()
+    address = 0
+    for octet in ip.split(b'.'):
+        if len(octet) > 3 or (len(octet) > 1 and octet[0] == 48 and not _leading_zeros) or int(octet) > 255:
+            address = INVALID
+            break
+        address = address << 8 | int(octet)
+    else:
+        if not _range_global[bisect_right(_range_starts, address) - 1]:
+            address = NOT_GLOBAL
+    _verdicts[ip] = address
+    return address
+
+
+def count_ips(addresses):
+    """
+    Count occurrences of IP addresses.
+
+    :param addresses: Buffer of IP addresses as unsigned 32-bit integers, e.g. `array('I')`.
+    :return: Sorted array of unique IP addresses, and array of their occurrence counts.
+    """
+
+    ips, counts = np.unique(np.frombuffer(addresses, dtype=np.uint32), return_counts=True)
+    return ips, counts.astype(np.int64)
+
+
+def merge_ip_counts(ip_counts):
+    """
+    Merge several unique IP address and occurrence count array pairs.
+
+    :param ip_counts: List of unique IP address and occurrence count array pairs.
+    :return: Sorted array of unique IP addresses, and array of their summed occurrence counts.
+    """
+
+    if not ip_counts:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64)
+    ips, inverse = np.unique(np.concatenate([ips for ips, _ in ip_counts]), return_inverse=True)
+    counts = np.bincount(
+        inverse.ravel(), weights=np.concatenate([counts for _, counts in ip_counts]), minlength=len(ips))
+    return ips.astype(np.uint32), counts.astype(np.int64)
+
+
+def hash_keys(values, seed):
+    """
+    Hash unsigned integers, e.g. IP addresses, into seeded pseudo random sampling keys, using the SplitMix64 finalizer.
+
+    :param values: Array of unsigned integers, of at most 64 bits.
+    :param seed: Random seed.
+    :return: Array of keys in the interval [0, 1).
+    """
+
+    x = values.astype(np.uint64) + np.uint64((seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+class IPReservoir(object):
+    """
+    Fixed size, uniform random sample of either IP occurrences or unique IPs, kept as the IPs with the smallest random
+    keys ("bottom-k" sampling). Reservoirs filled from separate parts of the log merge into a sample of the whole log.
+
+    Occurrences are keyed with a seeded hash of their log file and byte offset. Unique IPs are keyed with a seeded hash
+    of the IP, so a sampled IP keeps all of its occurrences. Either way, the sample doesn't depend on how the log was
+    split between processes.
+    """
+
+    def __init__(self, size, method, seed, source=0):
+        """
+
+        :param size: Maximum sample size.
+        :param method: Sampling method, either 'occurrences' or 'unique'.
+        :param seed: Random seed.
+        :param source: Unsigned 32-bit integer identifying the log file the reservoir is filled from, e.g. a hash of
+        its filename.
+        """
+        self.size = size
+        self.method = method
+        self.seed = seed
+        self.seen = 0  # IP occurrences offered to the reservoir
+        self.ips = np.empty(0, dtype=np.uint32)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.float64)
+        self.source = source
+
+    def _update(self, ips, counts, keys):
+        """
+        Add keyed IPs to the reservoir, and evict all but those with the smallest keys.
+
+        :param ips: Array of IP addresses.
+        :param counts: Array of their occurrence counts.
+        :param keys: Array of their sampling keys.
+        """
+
+        ips = np.concatenate([self.ips, ips])
+        counts = np.concatenate([self.counts, counts])
+        keys = np.concatenate([self.keys, keys])
+        if self.method == 'unique':
+            ips, index, inverse = np.unique(ips, return_index=True, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(ips)).astype(np.int64)
+            keys = keys[index]
+        if len(keys) > self.size:
+            keep = np.argpartition(keys, self.size - 1)[:self.size]
+            ips, counts, keys = ips[keep], counts[keep], keys[keep]
+        self.ips, self.counts, self.keys = ips.astype(np.uint32), counts, keys
+
+    def add(self, addresses, positions):
+        """
+        Offer IP occurrences to the reservoir.
+
+        :param addresses: Buffer of IP addresses as unsigned 32-bit integers, e.g. `array('I')`.
+        :param positions: Buffer of their byte offsets within the log file as unsigned 64-bit integers, e.g.
+        `array('Q')`.
+        """
+
+        addresses = np.frombuffer(addresses, dtype=np.uint32)
+        self.seen += len(addresses)
+        if self.method == 'unique':
+            ips, counts = np.unique(addresses, return_counts=True)
+            self._update(ips, counts.astype(np.int64), hash_keys(ips, self.seed))
+        else:
+            positions = np.frombuffer(positions, dtype=np.uint64) ^ np.uint64(self.source << 32)
+            self._update(addresses.copy(), np.ones(len(addresses), dtype=np.int64), hash_keys(positions, self.seed))
+
+    def merge(self, other):
+        """
+        Merge another reservoir's sample into this one.
+
+        :param other: `IPReservoir` using the same size, method, and seed.
+        """
+
+        self.seen += other.seen
+        self._update(other.ips, other.counts, other.keys)
+
+    def ip_counts(self):
+        """
+        Sampled IPs, and their sampled occurrence counts.
+
+        :return: Sorted array of unique sampled IP addresses, and array of their occurrence counts.
+        """
+
+        return merge_ip_counts([(self.ips, self.counts)])
+
+
+def detect_compression(head):
+    """
+    Detect log file compression from its leading bytes.
+
+    :param head: Leading bytes of the log file.
+    :return: Function opening the file decompressed, or None if the file isn't compressed.
+    """
+
+    for magic, opener in DECOMPRESSORS:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def expand_log_inputs(log_input):
+    """
+    Expand log input setting into a list of log filenames.
+
+    :param log_input: Log input filename, glob pattern, comma separated list of either, or a list of either.
+    :return: List of log filenames. Patterns matching nothing are kept as is, so they're reported as not found.
+    """
+
+    if isinstance(log_input, str):
+        log_input = log_input.split(',')
+    filenames = []
+    for pattern in log_input:
+        pattern = pattern.strip()
+        if pattern:
+            filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(filenames))
+
 
 class LogParser(object):
     """
-    Parse log input file and produce list of public IP addresses that can be geolocated.
+    Parse log input files and produce list of public IP addresses that can be geolocated. Log files may be plain, or
+    compressed with gzip, bzip2, or xz.
     """
 
     def __init__(self, filename, consider_multiple_ips=False):
+        """
+
+        :param filename: Log input filename, glob pattern, comma separated list of either, or a list of either.
+        :param consider_multiple_ips: Whether (True) or not (False) to consider multiple unique IPs within a single log
+        entry.
+        """
         self.filename = filename
+        self.filenames = expand_log_inputs(filename)
         self.multiple_ips = consider_multiple_ips
+        self.line_count = 0
+        self.ip_counts = None
+        self.checkpoints = []
+        self.resumed = False
+        self.sampling = None
+        self.incremental = False
 
     @staticmethod
     def _eval_ip(ip, n):
         """
         Evaluate IP address for inclusion within the IP list.
 
-        :param ip: IPv4 host address.
+        :param ip: IPv4 host address as bytes.
         :param n: Line number IP being evaluated was found on.
-        :return: Returns whether or not the IP should be considered as True or False.
+        :return: Integer address if the IP should be considered, otherwise a negative verdict.
         """
 
-        try:
-            if ip_address(ip).is_global:
-                logging.debug(
-                    "IP address '{} in line {} is public. Adding to IP list.".format(ip, n))
-                return True
+        address = classify_ip(ip)
+        if debug_sampler.sample():
+            ip = ip.decode('ascii')
+            if address >= 0:
+                logging.debug("IP address '%s' in line %s is public. Adding to IP list.", ip, n)
+            elif address == NOT_GLOBAL:
+                logging.debug("IP address '%s' in line %s isn't public. Can't add to IP list", ip, n)
             else:
-                logging.debug(
-                    "IP address '{}' in line {} isn't public. Can't add to IP list".format(ip, n))
-                return False
-        except AddressValueError:
-            logging.debug("IP address '{}' in line {} is an invalid format.".format(ip, n))
-            return False
+                logging.debug("IP address '%s' in line %s is an invalid format.", ip, n)
+        return address
+
+    @staticmethod
+    def _split_lines(buffer, start, end, size):
+        """
+        Split a byte range into spans of roughly `size` bytes that each end on a line boundary.
+
+        :param buffer: Bytes like object, e.g. memory-mapped log file.
+        :param start: Byte offset to start from. Expected to be the start of a line.
+        :param end: Byte offset to stop at.
+        :param size: Desired span size in bytes. Spans are extended to the next newline.
+        :return: Generator of start and stop byte offsets.
+        """
+
+        while start < end:
+            stop = min(start + size, end)
+            if stop < end:
+                newline = buffer.find(b'\n', stop - 1, end)
+                stop = end if newline == -1 else newline + 1
+            yield start, stop
+            start = stop
+
+    @staticmethod
+    def _read_chunks(buffer, start, end):
+        """
+        Read a byte range as large chunks that each end on a line boundary.
+
+        :param buffer: Bytes like object, e.g. memory-mapped log file.
+        :param start: Byte offset to start reading from. Expected to be the start of a line.
+        :param end: Byte offset to stop reading at.
+        :return: Generator of byte chunks.
+        """
+
+        for start_, stop_ in LogParser._split_lines(buffer, start, end, CHUNK_SIZE):
+            yield buffer[start_:stop_]
+
+    def _scan_chunks(self, chunks, max_sample, start=0):
+        """
+        Scan byte chunks for candidate IPs, while keeping track of log line numbers.
+
+        Lines without a candidate IP are never handled individually, only counted.
+
+        :param chunks: Iterable of byte chunks, each ending on a line boundary.
+        :param max_sample: Line number at which to stop scanning.
+        :param start: Byte offset of the first chunk within the log file.
+        :return: Generator of line number, list of unique candidate IPs (as bytes) found on that line, and byte offset
+        of the first of them within the log file.
+        """
+
+        self.line_count = 0
+        for chunk in chunks:
+            first_line = self.line_count + 1
+            if first_line >= max_sample:
+                break
+            n, pos, line_end = first_line, 0, -1
+            ips = []
+            for m in IP_PATTERN.finditer(chunk):
+                s = m.start()
+                if s > line_end:
+                    # Match is on a new line, so hand off the previous one before counting our way forward
+                    if ips:
+                        yield n, ips, start + pos
+                        ips = []
+                    n += chunk.count(b'\n', pos, s)
+                    pos = s
+                    if n >= max_sample:
+                        break
+                    line_end = chunk.find(b'\n', s)
+                    if line_end == -1:
+                        line_end = len(chunk)
+                ip = m.group()
+                if ip not in ips:
+                    ips.append(ip)
+            if ips:
+                yield n, ips, start + pos
+            start += len(chunk)
+            self.line_count += chunk.count(b'\n')
+            if not chunk.endswith(b'\n'):
+                self.line_count += 1  # Final line lacks a trailing newline
+        self.line_count = min(self.line_count, max_sample)
+
+    @staticmethod
+    def _read_stream_chunks(f):
+        """
+        Read a (decompressing) file object as large chunks that each end on a line boundary.
 
-    def _eval_log_file(self, filename, multiple_ips):
+        :param f: Binary file object.
+        :return: Generator of byte chunks.
+        """
+
+        remainder = b''
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            data = remainder + data
+            newline = data.rfind(b'\n')
+            if newline == -1:
+                remainder = data
+                continue
+            remainder = data[newline + 1:]
+            yield data[:newline + 1]
+        if remainder:
+            yield remainder
+
+    def _eval_chunks(self, chunks, multiple_ips, max_sample, reservoir=None, start=0):
+        """
+        Evaluate IPs found within byte chunks of a log file.
+
+        :param chunks: Iterable of byte chunks, each ending on a line boundary.
+        :param multiple_ips: Whether (True) or not (False) to consider multiple unique IPs within a single log entry.
+        :param max_sample: Line number, relative to the first chunk, at which to stop evaluating.
+        :param reservoir: `IPReservoir` to sample IP occurrences into, or None to keep all of them.
+        :param start: Byte offset of the first chunk within the log file, keying sampled occurrences.
+        :return: Sorted array of unique public IP addresses, array of their occurrence counts, count of lines
+        evaluated, and the reservoir.
+        """
+
+        addresses = array('I')  # Public IP occurrences as unsigned 32-bit integers
+        positions = array('Q')  # Sampled IP occurrences' byte offsets
+        ip_counts = (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64))
+        for n, m, offset in self._scan_chunks(chunks, max_sample, start):
+            if len(m) > 1 and not multiple_ips:
+                if debug_sampler.sample():
+                    logging.debug("Conflicting IPs ('%s') in line %s", [ip.decode('ascii') for ip in m], n)
+                continue
+            if debug_sampler.sample():
+                if len(m) > 1:
+                    logging.debug("Multiple IPs ('%s') in line %s", [ip.decode('ascii') for ip in m], n)
+                else:
+                    logging.debug("Found IP '%s' in line %s", m[0].decode('ascii'), n)
+            for i, ip in enumerate(m):
+                address = self._eval_ip(ip, n)
+                if address >= 0:
+                    addresses.append(address)
+                    if reservoir is not None:
+                        positions.append(offset + i)  # Unique per occurrence, as IPs are several bytes apart
+            if len(addresses) >= COMPACT_SIZE:
+                if reservoir is None:
+                    ip_counts = merge_ip_counts([ip_counts, count_ips(addresses)])
+                else:
+                    reservoir.add(addresses, positions)
+                    del positions[:]
+                del addresses[:]
+        flush_logging()  # Pool processes exit without flushing their logging
+        _verdicts.clear()  # Before the process picks up its next unit
+        if reservoir is not None:
+            reservoir.add(addresses, positions)
+            return reservoir.ip_counts() + (self.line_count, reservoir)
+        return merge_ip_counts([ip_counts, count_ips(addresses)]) + (self.line_count, None)
+
+    def _eval_unit(self, unit):
+        """
+        Evaluate a unit of work, being either a byte range of a plain log file, or a whole compressed log file.
+
+        Plain log files are memory-mapped, while compressed log files are decompressed as a stream.
+
+        :param unit: Log input filename, whether or not to consider multiple IPs per log entry, start and end byte
+        offsets, whether or not the file is compressed, and line number at which to stop evaluating.
+        :return: Sorted array of unique public IP addresses, array of their occurrence counts, count of lines
+        evaluated, and `IPReservoir` when sampling.
+        """
+
+        filename, multiple_ips, start, end, compressed, max_sample = unit
+        reservoir = None
+        if self.sampling is not None:
+            reservoir = IPReservoir(*self.sampling, source=zlib.crc32(filename.encode()))
+        if compressed:
+            logging.debug("Evaluating compressed log file '{}' as a stream.".format(filename))
+            with open(filename, 'rb') as f:
+                opener = detect_compression(f.read(HEAD_SIZE))
+            try:
+                with opener(filename, 'rb') as f:
+                    if start > 0:
+                        f.seek(start)  # Decompresses, and discards, the leading bytes evaluated before
+                    return self._eval_chunks(
+                        self._read_stream_chunks(f), multiple_ips, max_sample, reservoir, start)
+            except (OSError, EOFError, lzma.LZMAError) as e:
+                logging.error("Unable to decompress log file '{}': {}".format(filename, e))
+                return merge_ip_counts([]) + (0, reservoir)
+        if start > 0:
+            logging.debug(
+                "Evaluating byte range {}-{} of log file '{}'. Line numbers are relative to the range start."
+                .format(start, end, filename))
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return self._eval_chunks(
+                self._read_chunks(buffer, start, end), multiple_ips, max_sample, reservoir, start)
+
+    @staticmethod
+    def _worker_count():
+        """
+        Number of processes to parse the log file with.
+
+        :return: Configured parse worker count, or the system CPU count if not configured.
+        """
+
+        workers = app_settings['parse_workers']
+        if workers < 1:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+                logging.warning("Unable to dynamically ascertain system CPU count. Assuming one.")
+        return workers
+
+    @staticmethod
+    def _head_hash(buffer, length):
         """
-        Evaluate log and produce IP list.
+        Hash the leading bytes of a log file.
+
+        :param buffer: Memory-mapped log file.
+        :param length: Number of leading bytes to hash.
+        :return: Hex digest.
+        """
+
+        return hashlib.sha1(buffer[:length]).hexdigest()
+
+    def _checkpoint_start(self, filename, stat, head):
+        """
+        Find byte offset to resume evaluating a log file from, using its checkpoint within the location database.
+
+        Checkpoints are looked up by file identity (device and inode), so a renamed file keeps its checkpoint. A file
+        that shrank below its checkpoint offset, or whose leading bytes changed, was rotated or truncated, and is
+        evaluated from the start.
+
+        :param filename: Log input filename.
+        :param stat: Log file `os.stat_result`.
+        :param head: Leading bytes of the log file.
+        :return: Byte offset to resume from.
+        """
+
+        rows = LocationDB().select_(
+            'SELECT head_length, head_hash, offset FROM log_checkpoints WHERE device = ? AND inode = ?',
+            stat.st_dev, stat.st_ino)
+        if not rows:
+            logging.info("No checkpoint found for log file '{}'. Evaluating from the start.".format(filename))
+            return 0
+        head_length, head_hash, offset = rows[0]
+        if offset > stat.st_size or head_length > len(head) or self._head_hash(head, head_length) != head_hash:
+            logging.info(
+                "Log file '{}' was rotated or truncated since its checkpoint. Evaluating from the start."
+                .format(filename))
+            return 0
+        logging.info("Resuming log file '{}' from checkpoint at byte {} of {}.".format(filename, offset, stat.st_size))
+        return offset
+
+    def _rotated_start(self, filename, opener):
+        """
+        Find decompressed byte offset to resume evaluating a compressed log file from, by matching its decompressed
+        leading bytes to the checkpoint of the plain log file it was compressed from, e.g. by logrotate compressing
+        'access.log.1' to 'access.log.2.gz'. Compressing a file gives it a new identity, so it has no checkpoint of its
+        own.
+
+        :param filename: Compressed log input filename.
+        :param opener: Function opening the file decompressed.
+        :return: Decompressed byte offset to resume from.
+        """
+
+        try:
+            with opener(filename, 'rb') as f:
+                head = f.read(HEAD_SIZE)
+        except (OSError, EOFError, lzma.LZMAError):
+            return 0  # Reported when the file is evaluated
+        rows = LocationDB().select_(
+            'SELECT head_length, head_hash, offset FROM log_checkpoints WHERE head_length <= ?', len(head))
+        offsets = [offset for head_length, head_hash, offset in rows if self._head_hash(head, head_length) == head_hash]
+        if not offsets:
+            return 0
+        offset = max(offsets)
+        logging.info(
+            "Compressed log file '{}' was evaluated through decompressed byte {} before it was compressed. Resuming "
+            "from there.".format(filename, offset))
+        return offset
+
+    def _plan_file(self, filename, incremental):
+        """
+        Work out which part of a log file needs evaluating, and prepare its checkpoint.
+
+        Compressed log files are rotated, and no longer written to, so they're skipped entirely when their checkpoint
+        shows they were evaluated before, and otherwise evaluated from the end of the plain log file they were
+        compressed from, if it was evaluated before, or else whole.
 
         :param filename: Log input filename.
+        :param incremental: Whether (True) or not (False) to resume from, and prepare, a checkpoint.
+        :return: Start and end byte offsets to evaluate, and whether (True) or not (False) the file is compressed, or
+        None if there's nothing to evaluate. A compressed file's start offset is into its decompressed stream.
+        """
+
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            head = f.read(HEAD_SIZE)
+            compressed = detect_compression(head) is not None
+            start, end = 0, stat.st_size
+            if not end:
+                return None
+            if not incremental:
+                return start, end, compressed
+            start = self._checkpoint_start(filename, stat, head)
+            if compressed:
+                evaluated = start == end
+                start = 0 if evaluated else self._rotated_start(filename, detect_compression(head))
+            else:
+                # Only evaluate complete lines, as the last one may still be in the middle of being written
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    end = buffer.rfind(b'\n', start, end) + 1 or start
+                evaluated = end <= start
+            head_length = len(head)
+            self.checkpoints.append({
+                'device': stat.st_dev, 'inode': stat.st_ino, 'path': filename, 'size': stat.st_size,
+                'head_length': head_length, 'head_hash': self._head_hash(head, head_length), 'offset': end})
+            if start > 0 or evaluated:
+                self.resumed = True
+            return None if evaluated else (start, end, compressed)
+
+    def commit_checkpoint(self):
+        """
+        Save checkpoints of how far each log file was evaluated to the location database. Should be called only once
+        the IP list was successfully handled, so an interrupted run evaluates the same log lines again.
+        """
+
+        for c in self.checkpoints:
+            LocationDB().insert_(
+                '''
+                INSERT OR REPLACE INTO log_checkpoints
+                (device, inode, path, size, head_length, head_hash, offset, checkpoint_epoch)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''',
+                c['device'], c['inode'], c['path'], c['size'], c['head_length'], c['head_hash'], c['offset'],
+                int(time.time()))
+            logging.debug("Saved log file checkpoint: {}".format(c))
+
+    def _eval_log_file(self, filenames, multiple_ips):
+        """
+        Evaluate logs and produce IP list.
+
+        Unless a reduced sample is requested, plain log files are split into newline aligned byte ranges, and
+        compressed log files decompressed as whole streams, which are all evaluated in parallel, and their unique IPs
+        and occurrence counts merged.
+
+        :param filenames: List of log input filenames.
         :param multiple_ips: Whether (True) or not (False) to consider multiple unique IPs within a single log entry.
-        :return: List of public IP addresses.
+        :return: Numerically sorted NumPy array of unique public IP addresses.
         """
 
-        ip_list = []
-        logging.debug("Evaluating log file '" + filename + "'.")
+        reduced_sample = False
+        max_sample = float('inf')
+        self.sampling = None
         if app_settings['reduce_sample_size'] == 1:
-            reduced_sample = True
-            max_sample = app_settings['max_sample_size']
+            if app_settings['sample_method'] == 'head':
+                reduced_sample = True
+                max_sample = app_settings['max_sample_size']
+            else:
+                self.sampling = (
+                    app_settings['max_sample_size'], app_settings['sample_method'], app_settings['sample_seed'])
+        incremental = app_settings['incremental_input'] == 1 and app_settings['reduce_sample_size'] != 1
+        self.incremental = incremental
+        spans = []
+        for filename in filenames:
+            logging.debug("Evaluating log file '" + filename + "'.")
+            try:
+                span = self._plan_file(filename, incremental)
+            except FileNotFoundError:
+                raise GracefulException("File '{}' was not found!".format(filename))
+            if span is not None:
+                spans.append((filename,) + span)
+
+        # Only split plain log files when there's enough of them to be worth handing out to processes
+        workers = 1 if reduced_sample else self._worker_count()
+        plain_size = sum(end - start for _, start, end, compressed in spans if not compressed)
+        range_size = max(MIN_RANGE_SIZE, -(-plain_size // workers))
+        units = []
+        for filename, start, end, compressed in spans:
+            if compressed or reduced_sample:
+                units.append((filename, multiple_ips, start, end, compressed, max_sample))
+            else:
+                with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    units.extend(
+                        (filename, multiple_ips, start_, end_, False, max_sample)
+                        for start_, end_ in self._split_lines(buffer, start, end, range_size))
+
+        if reduced_sample:
+            # Reduced samples are the first lines of the log files, in order, so they're evaluated serially
+            results = []
+            for unit in units:
+                remaining = max_sample - sum(result[2] for result in results)
+                if remaining <= 0:
+                    break
+                results.append(self._eval_unit(unit[:-1] + (remaining,)))
+        elif len(units) > 1:
+            # Compressed files can't be split, so hand them out first, followed by the largest byte ranges
+            units.sort(key=lambda u: (not u[4], u[2] - u[3]))
+            workers = min(workers, len(units))
+            logging.debug("Starting {} processes to evaluate {} log file units.".format(workers, len(units)))
+            with multiprocessing.Pool(workers) as pool:
+                results = list(pool.imap_unordered(self._eval_unit, units))
+                # Let processes exit, rather than terminating them, so they finish queueing their logging
+                pool.close()
+                pool.join()
         else:
-            reduced_sample = False
-            max_sample = float('inf')
-        try:
-            with open(filename, 'rt') as f:
-                for n, l in enumerate(f, 1):
-                    if reduced_sample and n >= max_sample:
-                        logging.info("Reached reduced sample size limit of {} log lines.".format(max_sample))
-                        break
-                    try:
-                        m = re.findall(r'[0-9]+(?:\.[0-9]+){3}', l)  # Find IP(s) in line
-                        if m:
-                            m = list(set(m))  # Remove duplicates
-                            if len(m) > 1:
-                                if multiple_ips:
-                                    logging.debug("Multiple IPs ('{}') in line {}".format(m, n))
-                                    for ip in m:
-                                        if staticmethod(self._eval_ip(ip, n)):
-                                            ip_list.append(ip)
-                                else:
-                                    logging.debug("Conflicting IPs ('{}') in line {}".format(m, n))
-                                    pass
-                            else:
-                                ip, = m
-                                logging.debug("Found IP '{}' in line {}".format(ip, n))
-                                if staticmethod(self._eval_ip(ip, n)):
-                                    ip_list.append(ip)
-                    except TypeError:
-                        logging.debug("Unable to process line {}.".format(n))
-
-                # Remove duplicates, sort list pseudo numerically, return list
-                ips_total = len(ip_list)
-                ip_list = list(set(ip_list))
-                ips_unique = len(ip_list)
-                ip_list.sort()
-                logging.info(
-                    "Parsed {} log entries, evaluated {} IPs, and built list composed of {} unique public IPs."
-                    .format(n, ips_total, ips_unique))
-                log_percent = round(((ips_total / n) * 100), 2)
-                ips_percent = round(((ips_unique / ips_total) * 100), 2)
-                logging.info(
-                    "{}% of log entries contained an IP address, and of those {}% are geolocation eligible."
-                    .format(log_percent, ips_percent))
-                logging.debug("Produced IP list:\n{}".format(ip_list))
-                return ip_list
+            results = [self._eval_unit(unit) for unit in units]
+
+        # Merge process results
+        n = sum(result[2] for result in results)
+        if self.sampling is not None:
+            reservoir = IPReservoir(*self.sampling)
+            for result in results:
+                reservoir.merge(result[3])
+            ips, counts = reservoir.ip_counts()
+            logging.info(
+                "Sampled {} of {} public IP occurrences using '{}' sampling, with a sample size of {} and seed {}."
+                .format(int(counts.sum()), reservoir.seen, self.sampling[1], self.sampling[0], self.sampling[2]))
+        else:
+            ips, counts = merge_ip_counts([result[:2] for result in results])
+        if reduced_sample and n >= max_sample:
+            logging.info("Reached reduced sample size limit of {} log lines.".format(max_sample))
 
-        except FileNotFoundError:
-            raise GracefulException("File '{}' was not found!".format(filename))
+        ips_total = int(counts.sum()) if self.sampling is None else reservoir.seen
+        ips_unique = len(ips)
+        logging.info(
+            "Parsed {} log entries, evaluated {} IPs, and built list composed of {} unique public IPs."
+            .format(n, ips_total, ips_unique))
+        if n and ips_total and self.sampling is None:
+            log_percent = round(((ips_total / n) * 100), 2)
+            ips_percent = round(((ips_unique / ips_total) * 100), 2)
+            logging.info(
+                "{}% of log entries contained an IP address, and of those {}% are geolocation eligible."
+                .format(log_percent, ips_percent))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Produced IP list:\n{}".format([ip_to_str(ip) for ip in ips]))
+        self.ip_counts = counts
+        return ips
 
     def build_ip_list(self):
-        ip_list = self._eval_log_file(self.filename, self.multiple_ips)
-        if not ip_list:
+        """
+        Build list of public IP addresses found within the log files. Occurrence counts of each IP are kept in
+        `ip_counts`, aligned with the list.
+
+        :return: Numerically sorted NumPy array of unique public IP addresses as unsigned 32-bit integers.
+        """
+
+        ip_list = self._eval_log_file(self.filenames, self.multiple_ips)
+        if not len(ip_list):
+            if self.resumed:
+                logging.info("No new geolocation results since the log file checkpoints.")
+                return ip_list
             raise GracefulException("Parsing and evaluating log produced no geolocation results!")
         return ip_list
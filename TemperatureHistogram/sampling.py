@@ -0,0 +1,144 @@
+"""
+Exercise sampling module.
+"""
+
+import math
+import zlib
+
+import numpy as np
+
+# Two-sided standard normal critical values by confidence level (percent)
+Z_SCORES = {80: 1.2816, 90: 1.6449, 95: 1.9600, 98: 2.3263, 99: 2.5758}
+
+# Fewest units sampled per stratum, so each stratum's variance can be estimated
+MIN_STRATUM_SAMPLE = 2
+
+
+def sample_size(population, error, confidence):
+    """
+    Sample size estimating a proportion within a margin of error, assuming the most conservative proportion (0.5), and
+    applying the finite population correction.
+
+    :param population: Population size.
+    :param error: Margin of error, as a proportion, e.g. 0.05.
+    :param confidence: Confidence level (percent), one of `Z_SCORES`.
+    :return: Sample size, at most the population size.
+    """
+
+    if not population:
+        return 0
+    size = Z_SCORES[confidence] ** 2 * 0.25 / error ** 2
+    return min(population, math.ceil(size / (1 + (size - 1) / population)))
+
+
+def collapse(strata, size, parents):
+    """
+    Collapse strata too small to be allocated `MIN_STRATUM_SAMPLE` units of a sample in proportion to their sizes into
+    coarser strata, e.g. regions into their country, and then countries into a single stratum. Otherwise, many small
+    strata, each allocated the minimum, would inflate the sample well beyond its size.
+
+    :param strata: Dictionary of stratum to list of its units, e.g. IP addresses.
+    :param size: Sample size.
+    :param parents: List of functions mapping a stratum to its coarser stratum, from the finest to the coarsest.
+    :return: Dictionary of stratum to list of its units.
+    """
+
+    population = sum(len(units) for units in strata.values())
+    for parent in parents:
+        collapsed = {}
+        for stratum, units in strata.items():
+            if size * len(units) < MIN_STRATUM_SAMPLE * population:
+                stratum = parent(stratum)
+            collapsed.setdefault(stratum, []).extend(units)
+        strata = collapsed
+    return strata
+
+
+def allocate(stratum_sizes, size):
+    """
+    Allocate a sample across strata in proportion to their sizes. Each stratum is allocated at least
+    `MIN_STRATUM_SAMPLE` units, so its variance can be estimated, and at most its size.
+
+    :param stratum_sizes: List of stratum sizes.
+    :param size: Sample size.
+    :return: List of each stratum's sample size.
+    """
+
+    population = sum(stratum_sizes)
+    return [min(n, max(MIN_STRATUM_SAMPLE, math.ceil(size * n / population))) for n in stratum_sizes]
+
+
+def sample_key(unit):
+    """
+    Pseudorandom, but stable, sort key of a unit, e.g. an IP address. Sampling the units with the lowest keys draws the
+    same sample on every run, so a sample's forecasts fetched by one run are reused by the next.
+
+    :param unit: Unit string.
+    :return: Unsigned 32-bit integer key.
+    """
+
+    return zlib.crc32(unit.encode())
+
+
+def draw(strata, error, confidence):
+    """
+    Draw a stratified sample, sized to estimate proportions within a margin of error, with proportional allocation.
+
+    :param strata: Dictionary of stratum to list of its units, e.g. IP addresses.
+    :param error: Margin of error, as a proportion, e.g. 0.05.
+    :param confidence: Confidence level (percent), one of `Z_SCORES`.
+    :return: Dictionary of stratum to list of its sampled units.
+    """
+
+    stratum_sizes = [len(units) for units in strata.values()]
+    allocation = allocate(stratum_sizes, sample_size(sum(stratum_sizes), error, confidence))
+    return {
+        stratum: sorted(units, key=sample_key)[:n] for (stratum, units), n in zip(strata.items(), allocation)}
+
+
+class StratifiedSample(object):
+    """
+    Stratified sample's units, for estimating population totals, e.g. histogram bucket counts, with a margin of error.
+    Estimates are made from per stratum sums, so sampled units' values can be accumulated as they're streamed.
+    """
+
+    def __init__(self, units, population_sizes, confidence):
+        """
+
+        :param units: Dictionary of each sampled unit to its stratum index.
+        :param population_sizes: Array of each stratum's population size.
+        :param confidence: Confidence level (percent), one of `Z_SCORES`.
+        """
+        self.units = units
+        self.population_sizes = np.asarray(population_sizes, dtype=np.float64)
+        self.confidence = confidence
+
+    def estimate(self, sizes, sums, squares):
+        """
+        Estimate population totals, as the sum of each stratum's sample totals expanded to its population size.
+
+        :param sizes: Array of each stratum's count of sampled units observed.
+        :param sums: Array with a row per stratum, and a column per total, of the sum of its sampled units' values, e.g.
+        the weight of each unit whose temperature falls in the histogram bucket.
+        :param squares: Array shaped as `sums`, of the sum of its sampled units' squared values.
+        :return: Array of estimated totals, and array of their margins of error.
+        """
+
+        sizes = np.asarray(sizes, dtype=np.float64)
+        sampled = sizes > 0
+        expansion = np.zeros(len(sizes))
+        expansion[sampled] = self.population_sizes[sampled] / sizes[sampled]
+        totals = (expansion[:, np.newaxis] * sums).sum(axis=0)
+
+        # Stratified variance of a total, with the finite population correction. A stratum with a single observed unit,
+        # e.g. as the rest of its sample has a stale forecast, has no variance estimate of its own, so it's given the
+        # mean square of every observed unit's values, which bounds the variance from above.
+        n = sizes[sampled, np.newaxis]
+        variable = n[:, 0] > 1
+        variances = np.empty((len(n), sums.shape[1]))
+        variances[variable] = (squares[sampled][variable] - sums[sampled][variable] ** 2 / n[variable]) / (
+            n[variable] - 1)
+        variances[~variable] = squares.sum(axis=0) / max(sizes.sum(), 1)
+        population = self.population_sizes[sampled, np.newaxis]
+        variance = (population ** 2 * (1 - n / population) * variances / n).sum(axis=0)
+        return totals, Z_SCORES[self.confidence] * np.sqrt(np.maximum(variance, 0))
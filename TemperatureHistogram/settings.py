@@ -42,11 +42,67 @@ class _LazyParamDict(dict):
                 'owm_rpm': int(os.environ.get('OWM_RPM'))
             }
             # Optional params
+            params.update({
+                'parse_workers': int(os.environ.get('PARSE_WORKERS', 0)),
+                'incremental_input': int(os.environ.get('INCREMENTAL_INPUT', 1)),
+                'ip_epoch_max_age': int(os.environ.get('IP_EPOCH_MAX_AGE', 0)),
+                'geo_index': int(os.environ.get('GEO_INDEX', 1)),
+                'geo_cache_size': int(os.environ.get('GEO_CACHE_SIZE', 100000)),
+                'owm_api_url': os.environ.get('OWM_API_URL', 'https://api.openweathermap.org').rstrip('/'),
+                'owm_concurrency': int(os.environ.get('OWM_CONCURRENCY', 8)),
+                'owm_retries': int(os.environ.get('OWM_RETRIES', 5)),
+                'forecast_grid_precision': int(os.environ.get('FORECAST_GRID_PRECISION', 2)),
+                'forecast_cache_ttl': int(os.environ.get('FORECAST_CACHE_TTL', 6)),
+                'histogram_weighting': os.environ.get('HISTOGRAM_WEIGHTING', 'locations'),
+                'forecast_sample_error': float(os.environ.get('FORECAST_SAMPLE_ERROR', 0)),
+                'forecast_sample_confidence': int(os.environ.get('FORECAST_SAMPLE_CONFIDENCE', 95)),
+                'bucket_edges': os.environ.get('BUCKET_EDGES'),
+                'summary_output': os.environ.get('SUMMARY_OUTPUT') or None,
+                'sketch_accuracy': float(os.environ.get('SKETCH_ACCURACY', 0.01)),
+                'histogram_percentiles': [
+                    float(p) for p in os.environ.get('HISTOGRAM_PERCENTILES', '50,90,99').split(',') if p.strip()],
+                'histogram_group_by': os.environ.get('HISTOGRAM_GROUP_BY') or None,
+                'histogram_outputs': [
+                    o.strip() for o in os.environ.get('HISTOGRAM_OUTPUTS', 'tsv,log').split(',') if o.strip()],
+                'debug_sample_rate': float(os.environ.get('DEBUG_SAMPLE_RATE', 1))
+            })
+            if not 0 <= params['debug_sample_rate'] <= 1:
+                raise ValueError("Debug sample rate must be a proportion, e.g. 0.01")
+            for output in params['histogram_outputs']:
+                if output not in ('tsv', 'log', 'json', 'npz'):
+                    raise ValueError("Unknown histogram output '{}'".format(output))
+            if params['histogram_group_by'] not in (None, 'country', 'region'):
+                raise ValueError("Unknown histogram group by '{}'".format(params['histogram_group_by']))
+            if params['histogram_group_by'] and params['forecast_sample_error'] > 0:
+                raise ValueError("Grouped histograms can't be estimated from a forecast sample")
+            if not 0 < params['sketch_accuracy'] < 1:
+                raise ValueError("Sketch accuracy must be a proportion, e.g. 0.01")
+            if not all(0 <= p <= 100 for p in params['histogram_percentiles']):
+                raise ValueError("Histogram percentiles must be between 0 and 100")
+            if params['bucket_edges']:
+                params['bucket_edges'] = [float(edge) for edge in params['bucket_edges'].split(',')]
+                if len(params['bucket_edges']) < 2 or params['bucket_edges'] != sorted(set(params['bucket_edges'])):
+                    raise ValueError("Bucket edges must be two or more increasing temperatures")
+                params['buckets'] = len(params['bucket_edges']) - 1
+            else:
+                params['bucket_edges'] = None
+            if params['histogram_weighting'] not in ('locations', 'hits'):
+                raise ValueError("Unknown histogram weighting '{}'".format(params['histogram_weighting']))
+            if not 0 <= params['forecast_sample_error'] < 1:
+                raise ValueError("Forecast sample error must be a proportion, e.g. 0.05")
+            if params['forecast_sample_confidence'] not in (80, 90, 95, 98, 99):
+                raise ValueError("Unknown forecast sample confidence '{}'".format(params['forecast_sample_confidence']))
             if params['reduce_sample_size'] == 1:
                 try:
-                    params.update({'max_sample_size': int(os.environ.get('MAX_SAMPLE_SIZE'))})
+                    params.update({
+                        'max_sample_size': int(os.environ.get('MAX_SAMPLE_SIZE')),
+                        'sample_method': os.environ.get('SAMPLE_METHOD', 'head'),
+                        'sample_seed': int(os.environ.get('SAMPLE_SEED', 0))
+                    })
+                    if params['sample_method'] not in ('head', 'occurrences', 'unique'):
+                        raise ValueError("Unknown sample method '{}'".format(params['sample_method']))
                 except Exception as e:
-                    logging.error("Reduced sample size enabled, but unable to set sample size!")
+                    logging.error("Reduced sample size enabled, but unable to set sample size or method!")
                     logging.fatal(e)
             for k, v in params.items():
                 dict.__setitem__(self, k, v)
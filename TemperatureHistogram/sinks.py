@@ -0,0 +1,164 @@
+"""
+Exercise histogram output sinks module.
+"""
+
+import io
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+OUTPUTS = ('tsv', 'log', 'json', 'npz')
+
+
+def write_atomically(filename, data):
+    """
+    Write a file by renaming a complete temporary file over it, so concurrent readers never see a partial file.
+
+    :param filename: Filename.
+    :param data: File content bytes.
+    """
+
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_filename, 0o644)  # As readable as a file written in place
+        os.replace(temp_filename, filename)
+    except OSError:
+        os.remove(temp_filename)
+        raise
+
+
+class HistogramResult(object):
+    """
+    Histogram rendered once, in memory, for every sink to output.
+    """
+
+    def __init__(self, columns, values, text, percentiles, metadata):
+        """
+
+        :param columns: List of column names, e.g. 'bucketMin', 'bucketMax', and 'count'.
+        :param values: List of each column's array of values.
+        :param text: Tab delimited text, as saved by the tsv sink, and logged by the log sink.
+        :param percentiles: List of percentile, and temperature, or None when unknown.
+        :param metadata: Dictionary of histogram properties, e.g. its bucket count.
+        """
+        self.columns = columns
+        self.values = values
+        self.text = text
+        self.percentiles = percentiles
+        self.metadata = metadata
+
+
+class TsvSink(object):
+    """
+    Tab delimited text file, as produced historically.
+    """
+
+    def __init__(self, filename):
+        """
+
+        :param filename: Output filename.
+        """
+        self.filename = filename
+
+    def write_(self, result):
+        """
+        Output histogram.
+
+        :param result: `HistogramResult`.
+        """
+
+        write_atomically(self.filename, result.text.encode())
+
+
+class LogSink(object):
+    """
+    Tab delimited text, logged.
+    """
+
+    filename = None
+
+    @staticmethod
+    def write_(result):
+        """
+        Output histogram.
+
+        :param result: `HistogramResult`.
+        """
+
+        logging.info("Histogram, tab delimited:\n" + result.text.replace('\r\n', '\n'))
+
+
+class JsonSink(object):
+    """
+    JSON document, with a row object per bucket, for dashboards.
+    """
+
+    def __init__(self, filename):
+        """
+
+        :param filename: Output filename.
+        """
+        self.filename = filename
+
+    def write_(self, result):
+        """
+        Output histogram.
+
+        :param result: `HistogramResult`.
+        """
+
+        rows = [dict(zip(result.columns, row)) for row in zip(*(values.tolist() for values in result.values))]
+        document = dict(result.metadata, buckets=rows, percentiles=[
+            {'percentile': percentile, 'temperature': temperature} for percentile, temperature in result.percentiles])
+        write_atomically(self.filename, json.dumps(document, indent=2).encode())
+
+
+class NpzSink(object):
+    """
+    NumPy `.npz` file, of an array per column, for columnar consumers.
+    """
+
+    def __init__(self, filename):
+        """
+
+        :param filename: Output filename.
+        """
+        self.filename = filename
+
+    def write_(self, result):
+        """
+        Output histogram.
+
+        :param result: `HistogramResult`.
+        """
+
+        f = io.BytesIO()
+        percentiles = [(p, np.nan if t is None else t) for p, t in result.percentiles]
+        np.savez(
+            f, percentiles=np.array([p for p, _ in percentiles], dtype=np.float64),
+            percentileTemperatures=np.array([t for _, t in percentiles], dtype=np.float64),
+            **dict(zip(result.columns, result.values)))
+        write_atomically(self.filename, f.getvalue())
+
+
+def build_sinks(outputs, tsv_filename):
+    """
+    Build output sinks. Sinks other than the tsv file are saved next to it, named after it.
+
+    :param outputs: List of outputs, of `OUTPUTS`.
+    :param tsv_filename: Tab delimited text output filename.
+    :return: List of sinks.
+    """
+
+    base = os.path.splitext(tsv_filename)[0]
+    sinks = {
+        'tsv': lambda: TsvSink(tsv_filename),
+        'log': LogSink,
+        'json': lambda: JsonSink(base + '.json'),
+        'npz': lambda: NpzSink(base + '.npz')}
+    return [sinks[output]() for output in outputs]
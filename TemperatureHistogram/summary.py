@@ -0,0 +1,335 @@
+"""
+Exercise histogram summary module.
+"""
+
+import math
+import struct
+
+import numpy as np
+
+from TemperatureHistogram.sinks import write_atomically
+
+SUMMARY_MAGIC = b'THS1'  # Histogram summary blob format identifier, and version
+# Little-endian header: magic, relative accuracy, bucket count, positive and negative sketch key counts, zero count,
+# lowest and highest temperature, temperatures, nulls, and temperatures outside the bucket edges, and approximate flag
+SUMMARY_HEADER = struct.Struct('<4sdIIIdddQQQ?')
+SKETCH_MIN_VALUE = 1e-9  # Smallest magnitude kept apart from zero by a quantile sketch
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch, in the style of DDSketch (https://arxiv.org/abs/1908.10693). Values are counted within
+    logarithmically sized buckets, so any quantile is returned within a relative error of the configured accuracy,
+    however many values are added, and sketches merge exactly by adding their bucket counts.
+    """
+
+    def __init__(self, accuracy, positive=None, negative=None, zero=0.0):
+        """
+
+        :param accuracy: Relative accuracy of quantiles, e.g. 0.01 for 1%.
+        :param positive: Dictionary of bucket key to count of positive values.
+        :param negative: Dictionary of bucket key to count of negative values, keyed by magnitude.
+        :param zero: Count of values too close to zero to bucket.
+        """
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.positive = positive or {}
+        self.negative = negative or {}
+        self.zero = zero
+
+    @staticmethod
+    def _add_keys(store, keys, weights):
+        """
+        Add weights into a store's buckets.
+
+        :param store: Dictionary of bucket key to count.
+        :param keys: Array of bucket keys.
+        :param weights: Array of weights.
+        """
+
+        if not len(keys):
+            return
+        unique, inverse = np.unique(keys, return_inverse=True)
+        for key, count in zip(unique.tolist(), np.bincount(inverse, weights=weights).tolist()):
+            store[key] = store.get(key, 0.0) + count
+
+    def add(self, values, weights):
+        """
+        Add values.
+
+        :param values: Array of values.
+        :param weights: Array of each value's weight.
+        """
+
+        magnitudes = np.abs(values)
+        nonzero = magnitudes >= SKETCH_MIN_VALUE
+        keys = np.zeros(len(values), dtype=np.int64)
+        keys[nonzero] = np.ceil(np.log(magnitudes[nonzero]) / math.log(self.gamma))
+        self._add_keys(self.positive, keys[nonzero & (values > 0)], weights[nonzero & (values > 0)])
+        self._add_keys(self.negative, keys[nonzero & (values < 0)], weights[nonzero & (values < 0)])
+        self.zero += float(weights[~nonzero].sum())
+
+    def merge(self, other):
+        """
+        Add another sketch's counts.
+
+        :param other: `QuantileSketch` of the same accuracy.
+        """
+
+        if other.accuracy != self.accuracy:
+            raise ValueError(
+                "Can't merge quantile sketches of {} and {} accuracy".format(self.accuracy, other.accuracy))
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0.0) + count
+        self.zero += other.zero
+
+    def count(self):
+        """
+        Total weight of values added.
+
+        :return: Count.
+        """
+
+        return sum(self.positive.values()) + sum(self.negative.values()) + self.zero
+
+    def _value(self, key):
+        """
+        Value representing a bucket, within the relative accuracy of every value in it.
+
+        :param key: Bucket key.
+        :return: Value magnitude.
+        """
+
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def buckets(self):
+        """
+        Buckets in ascending value order.
+
+        :return: Array of each bucket's representative value, and array of its count.
+        """
+
+        negative = sorted(self.negative.items(), reverse=True)
+        positive = sorted(self.positive.items())
+        values = [-self._value(key) for key, _ in negative] + [0.0] + [self._value(key) for key, _ in positive]
+        counts = [count for _, count in negative] + [self.zero] + [count for _, count in positive]
+        return np.array(values, dtype=np.float64), np.array(counts, dtype=np.float64)
+
+    def ranges(self):
+        """
+        Value ranges of buckets in ascending value order.
+
+        :return: Array of each bucket's lowest value, array of its highest value, and array of its count.
+        """
+
+        negative = sorted(self.negative.items(), reverse=True)
+        positive = sorted(self.positive.items())
+        lows = [-self.gamma ** key for key, _ in negative] + [0.0] + [self.gamma ** (key - 1) for key, _ in positive]
+        highs = [-self.gamma ** (key - 1) for key, _ in negative] + [0.0] + [self.gamma ** key for key, _ in positive]
+        counts = [count for _, count in negative] + [self.zero] + [count for _, count in positive]
+        return (
+            np.array(lows, dtype=np.float64), np.array(highs, dtype=np.float64), np.array(counts, dtype=np.float64))
+
+    def quantile(self, q):
+        """
+        Estimate a quantile.
+
+        :param q: Quantile, between 0 and 1.
+        :return: Value within the relative accuracy of the quantile, or None when the sketch is empty.
+        """
+
+        values, counts = self.buckets()
+        total = counts.sum()
+        if not total:
+            return None
+        # First bucket whose cumulative count exceeds the quantile's rank, as DDSketch ranks them
+        bucket = np.searchsorted(np.cumsum(counts), q * (total - 1), side='right')
+        return float(values[min(bucket, len(values) - 1)])
+
+
+class HistogramSummary(object):
+    """
+    Mergeable summary of temperatures: counts within fixed bucket edges, and a quantile sketch. Summaries of separate
+    runs, e.g. one per log source or host, serialize to a small binary blob, and merge into the summary of a single run
+    over all of their temperatures.
+
+    Counts merge exactly when every summary shares the same bucket edges, e.g. `bucket_edges` is configured. Otherwise
+    the merged summary's edges are derived from the overall lowest and highest temperature, as a single run derives
+    them, and its counts are re-binned from the merged quantile sketch, by spreading each sketch bucket's count evenly
+    across its value range. Only temperatures within the sketch's relative accuracy of a bucket edge may be counted in
+    the neighbouring bucket.
+    """
+
+    def __init__(self, edges, accuracy, sketch=None, counts=None):
+        """
+
+        :param edges: Array of bucket edges.
+        :param accuracy: Quantile sketch relative accuracy, e.g. 0.01 for 1%.
+        :param sketch: `QuantileSketch`, or None for an empty one.
+        :param counts: Array of bucket counts, or None for zeros.
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.bins = len(self.edges) - 1
+        self.sketch = sketch or QuantileSketch(accuracy)
+        self.counts = np.zeros(self.bins) if counts is None else np.asarray(counts, dtype=np.float64)
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.temperatures = 0  # Non-null temperatures added
+        self.nulls = 0  # Null temperatures skipped
+        self.outside = 0  # Temperatures outside the bucket edges
+        self.approximate = False  # Whether counts were re-binned from the quantile sketch
+
+    def add(self, temperatures, weights=None):
+        """
+        Add a chunk of temperatures into their buckets, and the quantile sketch.
+
+        :param temperatures: Array of temperatures, NaN when null.
+        :param weights: Array of each temperature's weight, e.g. its location's hits, or None to count each once.
+        :return: Array of each temperature's bucket index, and boolean array of whether it's within a bucket.
+        """
+
+        nulls = np.isnan(temperatures)
+        buckets = np.searchsorted(self.edges, temperatures, side='right') - 1
+        buckets[temperatures == self.edges[-1]] = self.bins - 1  # Last bucket is closed, as with NumPy's `histogram`
+        inside = ~nulls & (buckets >= 0) & (buckets < self.bins)
+        weights = np.ones(len(temperatures)) if weights is None else weights
+        self.counts += np.bincount(buckets[inside], weights=weights[inside], minlength=self.bins)
+        self.sketch.add(temperatures[~nulls], weights[~nulls])
+        if (~nulls).any():
+            self.minimum = min(self.minimum, float(temperatures[~nulls].min()))
+            self.maximum = max(self.maximum, float(temperatures[~nulls].max()))
+        self.temperatures += int(np.count_nonzero(~nulls))
+        self.nulls += int(np.count_nonzero(nulls))
+        self.outside += int(np.count_nonzero(~nulls & ~inside))
+        return buckets, inside
+
+    def _rebin(self, edges):
+        """
+        Re-bin counts from the quantile sketch into new bucket edges, spreading each sketch bucket's count evenly across
+        its value range.
+
+        :param edges: Array of bucket edges.
+        """
+
+        lows, highs, counts = self.sketch.ranges()
+        # Sketch buckets may stray past the extremes, which are known exactly
+        lows = np.clip(lows, self.minimum, self.maximum)
+        highs = np.clip(highs, self.minimum, self.maximum)
+        widths = highs - lows
+        self.edges = np.asarray(edges, dtype=np.float64)
+        # Share of each sketch bucket below each edge. Zero width buckets are wholly below edges past their value.
+        below = np.where(
+            widths[:, np.newaxis] > 0,
+            np.clip((self.edges - lows[:, np.newaxis]) / np.where(widths > 0, widths, 1)[:, np.newaxis], 0, 1),
+            self.edges > lows[:, np.newaxis])
+        below_edges = counts.dot(below)
+        below_edges[-1] = counts.sum()  # Last bucket is closed
+        self.counts = np.diff(below_edges)
+        self.outside = 0
+
+    def merge(self, other):
+        """
+        Merge another summary into this one.
+
+        :param other: `HistogramSummary` of the same bucket count, and quantile sketch accuracy.
+        :return: This summary.
+        """
+
+        if other.bins != self.bins:
+            raise ValueError("Can't merge histogram summaries of {} and {} buckets".format(self.bins, other.bins))
+        if not self.temperatures:
+            # Nothing to re-bin, so take on the other summary's edges
+            self.edges, self.counts, self.outside = other.edges.copy(), other.counts.copy(), other.outside
+            self.approximate = other.approximate
+        elif other.temperatures:
+            if self.approximate or other.approximate or not np.array_equal(self.edges, other.edges):
+                self.approximate = True
+            else:
+                self.counts += other.counts
+                self.outside += other.outside
+        self.sketch.merge(other.sketch)
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.temperatures += other.temperatures
+        self.nulls += other.nulls
+        if self.approximate:
+            # Derive edges from the overall temperature range, as a single run does, and re-bin the merged sketch
+            self._rebin(np.histogram_bin_edges(np.empty(0), bins=self.bins, range=(self.minimum, self.maximum)))
+        return self
+
+    def percentiles(self, percentiles):
+        """
+        Estimate temperature percentiles from the quantile sketch.
+
+        :param percentiles: List of percentiles, between 0 and 100.
+        :return: List of temperatures, each within the quantile sketch's relative accuracy, or None when empty.
+        """
+
+        return [self.sketch.quantile(percentile / 100) for percentile in percentiles]
+
+    def to_bytes(self):
+        """
+        Serialize summary.
+
+        :return: Summary blob bytes.
+        """
+
+        positive = sorted(self.sketch.positive.items())
+        negative = sorted(self.sketch.negative.items())
+        header = SUMMARY_HEADER.pack(
+            SUMMARY_MAGIC, self.sketch.accuracy, self.bins, len(positive), len(negative), self.sketch.zero,
+            self.minimum, self.maximum, self.temperatures, self.nulls, self.outside, self.approximate)
+        return b''.join([header, self.edges.astype('<f8').tobytes(), self.counts.astype('<f8').tobytes()] + [
+            np.array([item[i] for item in store], dtype=dtype).tobytes()
+            for store in (positive, negative) for i, dtype in ((0, '<i4'), (1, '<f8'))])
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """
+        Deserialize summary.
+
+        :param blob: Summary blob bytes, as `to_bytes` serializes them.
+        :return: `HistogramSummary`.
+        """
+
+        (magic, accuracy, bins, positive_count, negative_count, zero, minimum, maximum, temperatures, nulls, outside,
+         approximate) = SUMMARY_HEADER.unpack_from(blob)
+        if magic != SUMMARY_MAGIC:
+            raise ValueError("Not a histogram summary")
+        offset = SUMMARY_HEADER.size
+        arrays = []
+        for dtype, length in (('<f8', bins + 1), ('<f8', bins), ('<i4', positive_count), ('<f8', positive_count),
+                              ('<i4', negative_count), ('<f8', negative_count)):
+            arrays.append(np.frombuffer(blob, dtype=dtype, count=length, offset=offset))
+            offset += arrays[-1].nbytes
+        edges, counts, positive_keys, positive_counts, negative_keys, negative_counts = arrays
+        sketch = QuantileSketch(
+            accuracy, dict(zip(positive_keys.tolist(), positive_counts.tolist())),
+            dict(zip(negative_keys.tolist(), negative_counts.tolist())), zero)
+        summary = cls(edges, accuracy, sketch, counts.copy())
+        summary.minimum, summary.maximum = minimum, maximum
+        summary.temperatures, summary.nulls, summary.outside = temperatures, nulls, outside
+        summary.approximate = approximate
+        return summary
+
+    def save_(self, filename):
+        """
+        Save summary blob, replacing any existing file atomically.
+
+        :param filename: Summary filename.
+        """
+
+        write_atomically(filename, self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load summary blob.
+
+        :param filename: Summary filename.
+        :return: `HistogramSummary`.
+        """
+
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
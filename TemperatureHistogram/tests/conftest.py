@@ -0,0 +1,35 @@
+"""
+Test configuration. Puts the repository root on the import path, so the `TemperatureHistogram` package imports however
+the tests are run, e.g. `pytest TemperatureHistogram/tests`.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from TemperatureHistogram.geolocation import LocationDB  # noqa: E402
+from TemperatureHistogram.settings import app_settings  # noqa: E402
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    """
+    Application settings populated from a minimal environment, with an initialized location database within a
+    temporary directory. Tests override further settings by assigning them.
+
+    :return: `app_settings`.
+    """
+
+    for name, value in (
+            ('LOG_INPUT', str(tmp_path / 'access.log')), ('REDUCE_SAMPLE_SIZE', '0'),
+            ('TSV_OUTPUT', str(tmp_path / 'histogram.tsv')), ('BUCKETS', '5'), ('FAUX_TEMPERATURE_DATA', '0'),
+            ('OWM_API_KEY', 'test'), ('OWM_RPM', '60'), ('PARSE_WORKERS', '1')):
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(app_settings, '_populated', False)
+    app_settings['log_input']  # Populate
+    app_settings['location_db'] = str(tmp_path / 'location.db')
+    LocationDB().initialize_()
+    return app_settings
@@ -0,0 +1,141 @@
+"""
+Log input module tests.
+"""
+
+import gzip
+import os
+import random
+import unittest
+from ipaddress import ip_address, ip_network
+
+from TemperatureHistogram.log_input import INVALID, NOT_GLOBAL, SPECIAL_PURPOSE_NETWORKS, LogParser, classify_ip
+
+
+def expected_verdict(ip):
+    """
+    Verdict of the `ipaddress` library, as `classify_ip` returns it.
+
+    :param ip: Candidate IPv4 host address string.
+    :return: Integer address if public, `NOT_GLOBAL` if special purpose, or `INVALID` if not an IPv4 host address.
+    """
+
+    try:
+        address = ip_address(ip)
+    except ValueError:
+        return INVALID
+    return int(address) if address.is_global else NOT_GLOBAL
+
+
+class ClassifyIPTest(unittest.TestCase):
+    """
+    `classify_ip` verdicts match `ipaddress.ip_address(ip).is_global`.
+    """
+
+    def assert_verdicts(self, ips):
+        for ip in ips:
+            self.assertEqual(classify_ip(ip.encode()), expected_verdict(ip), ip)
+
+    def test_range_boundaries(self):
+        addresses = {0, 2 ** 32 - 1}
+        for network in SPECIAL_PURPOSE_NETWORKS:
+            network = ip_network(network)
+            for boundary in (int(network.network_address), int(network.broadcast_address)):
+                addresses.update(a for a in (boundary - 1, boundary, boundary + 1) if 0 <= a < 2 ** 32)
+        self.assert_verdicts(str(ip_address(a)) for a in sorted(addresses))
+
+    def test_random_addresses(self):
+        generator = random.Random(0)
+        self.assert_verdicts(str(ip_address(generator.getrandbits(32))) for _ in range(200000))
+
+    def test_leading_zeros(self):
+        self.assert_verdicts(['01.2.3.4', '8.8.8.08', '008.8.8.8', '10.0.0.01', '0.0.0.0', '00.0.0.0', '0008.8.8.8'])
+
+    def test_invalid(self):
+        self.assert_verdicts(['999.1.1.1', '256.0.0.1', '1.2.3.256', '1.2.3.999', '1000.1.1.1'])
+
+
+def parse(log_input):
+    """
+    Parse log input incrementally, as a run does, committing its checkpoints.
+
+    :param log_input: Log input filename, or glob pattern.
+    :return: Dictionary of each public IP string to its occurrence count, and `LogParser`.
+    """
+
+    parser = LogParser(log_input)
+    ips = parser.build_ip_list()
+    parser.commit_checkpoint()
+    counts = parser.ip_counts.tolist() if len(ips) else []
+    return {str(ip_address(ip)): count for ip, count in zip(ips.tolist(), counts)}, parser
+
+
+def test_checkpoint_resumes_appended_lines(settings, tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n8.8.4.4 GET /\n')
+    assert parse(str(log))[0] == {'8.8.4.4': 1, '8.8.8.8': 1}
+    with log.open('ab') as f:
+        f.write(b'1.1.1.1 GET /\n8.8.8.8 GET /\n')
+    counts, parser = parse(str(log))
+    assert counts == {'1.1.1.1': 1, '8.8.8.8': 1}
+    assert parser.resumed
+
+
+def test_checkpoint_leaves_incomplete_line(settings, tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n1.1.1.1 GE')
+    assert parse(str(log))[0] == {'8.8.8.8': 1}
+    with log.open('ab') as f:
+        f.write(b'T /\n')
+    assert parse(str(log))[0] == {'1.1.1.1': 1}
+
+
+def test_checkpoint_without_new_lines(settings, tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n')
+    parse(str(log))
+    counts, parser = parse(str(log))
+    assert counts == {}
+    assert parser.resumed
+
+
+def test_checkpoint_of_truncated_file(settings, tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n8.8.4.4 GET /\n')
+    parse(str(log))
+    log.write_bytes(b'1.1.1.1 GET /\n')  # Truncated in place, keeping its inode
+    assert parse(str(log))[0] == {'1.1.1.1': 1}
+
+
+def test_checkpoint_only_once_committed(settings, tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n')
+    LogParser(str(log)).build_ip_list()  # Interrupted before its IP list was handled
+    assert parse(str(log))[0] == {'8.8.8.8': 1}
+
+
+def test_checkpoint_ignored_when_not_incremental(settings, tmp_path):
+    settings['incremental_input'] = 0
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n')
+    parse(str(log))
+    assert parse(str(log))[0] == {'8.8.8.8': 1}
+
+
+def test_checkpoint_resumes_compressed_rotation(settings, tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_bytes(b'8.8.8.8 GET /\n')
+    parse(str(tmp_path / 'access.log*'))
+    with log.open('ab') as f:
+        f.write(b'1.1.1.1 GET /\n')
+    with gzip.open(str(tmp_path / 'access.log.1.gz'), 'wb') as f:
+        f.write(log.read_bytes())  # Rotated and compressed, before being evaluated again
+    os.remove(str(log))
+    log.write_bytes(b'8.8.4.4 GET /\n')
+    assert parse(str(tmp_path / 'access.log*'))[0] == {'1.1.1.1': 1, '8.8.4.4': 1}
+    counts, parser = parse(str(tmp_path / 'access.log*'))
+    assert counts == {}  # Compressed log file skipped once evaluated
+    assert parser.resumed
+
+
+if __name__ == '__main__':
+    unittest.main()
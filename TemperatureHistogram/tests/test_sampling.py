@@ -0,0 +1,75 @@
+"""
+Exercise sampling module.
+"""
+
+import numpy as np
+
+from TemperatureHistogram.sampling import (
+    MIN_STRATUM_SAMPLE, StratifiedSample, allocate, collapse, draw, sample_size)
+
+
+def estimate(population_values, sample_values, confidence=95):
+    """
+    Estimate a population total of values from a stratified sample of them.
+
+    :param population_values: List of each stratum's population values.
+    :param sample_values: List of each stratum's sampled values.
+    :param confidence: Confidence level (percent).
+    :return: Estimated total, and its margin of error.
+    """
+
+    sample = StratifiedSample({}, [len(values) for values in population_values], confidence)
+    totals, margins = sample.estimate(
+        [len(values) for values in sample_values],
+        np.array([[sum(values)] for values in sample_values], dtype=np.float64),
+        np.array([[sum(value ** 2 for value in values)] for values in sample_values], dtype=np.float64))
+    return totals[0], margins[0]
+
+
+def test_sample_size():
+    assert sample_size(0, 0.05, 95) == 0
+    assert sample_size(10, 0.05, 95) == 10
+    assert sample_size(1000000, 0.05, 95) == 385
+    assert sample_size(1000, 0.05, 95) == 278
+
+
+def test_collapse_small_strata():
+    strata = {('US', 'CA'): list(range(500)), ('US', 'NV'): list(range(3)), ('FR', 'IDF'): list(range(2))}
+    collapsed = collapse(strata, 100, [lambda stratum: (stratum[0], ''), lambda stratum: ('', '')])
+    assert {stratum: len(units) for stratum, units in collapsed.items()} == {('US', 'CA'): 500, ('', ''): 5}
+
+
+def test_allocate_bounds():
+    assert allocate([1000, 10, 1], 100) == [99, MIN_STRATUM_SAMPLE, 1]
+
+
+def test_draw_stable():
+    strata = {'a': [str(i) for i in range(1000)], 'b': [str(i) for i in range(1000, 1100)]}
+    sample = draw(strata, 0.1, 95)
+    assert sample == draw({stratum: units[::-1] for stratum, units in strata.items()}, 0.1, 95)
+    assert sum(len(units) for units in sample.values()) >= sample_size(1100, 0.1, 95)
+
+
+def test_estimate_fully_sampled():
+    total, margin = estimate([[1, 0, 1], [0, 1]], [[1, 0, 1], [0, 1]])
+    assert total == 3
+    assert margin == 0
+
+
+def test_estimate_margins_of_expanded_strata():
+    # A stratum with a single observed unit borrows every observed unit's mean square
+    for sample_values in ([[1, 0], [1, 1]], [[1, 0], [1]], [[1], [1]]):
+        total, margin = estimate([[1, 0] * 50, [1, 1] * 50], sample_values)
+        assert margin > 0
+
+
+def test_estimate_coverage():
+    rng = np.random.RandomState(0)
+    population_values = [list((rng.random_sample(size) < p).astype(int)) for size, p in ((2000, 0.3), (500, 0.7))]
+    true_total = sum(sum(values) for values in population_values)
+    covered = 0
+    for _ in range(400):
+        sample_values = [list(rng.choice(values, 60, replace=False)) for values in population_values]
+        total, margin = estimate(population_values, sample_values)
+        covered += abs(total - true_total) <= margin
+    assert 0.9 <= covered / 400 <= 0.99
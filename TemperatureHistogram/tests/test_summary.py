@@ -0,0 +1,96 @@
+"""
+Exercise histogram summary module.
+"""
+
+import numpy as np
+import pytest
+
+from TemperatureHistogram.summary import HistogramSummary, QuantileSketch
+
+ACCURACY = 0.01
+
+
+def summarize(temperatures, edges):
+    """
+    Summarize temperatures.
+
+    :param temperatures: Array of temperatures, NaN when null.
+    :param edges: Array of bucket edges.
+    :return: `HistogramSummary`.
+    """
+
+    summary = HistogramSummary(edges, ACCURACY)
+    summary.add(temperatures)
+    return summary
+
+
+def temperatures(seed, size):
+    """
+    Pseudorandom temperatures, some below zero, and some null.
+
+    :param seed: Random seed.
+    :param size: Count of temperatures.
+    :return: Array of temperatures.
+    """
+
+    rng = np.random.RandomState(seed)
+    values = rng.normal(50, 30, size)
+    values[rng.random_sample(size) < 0.05] = np.nan
+    values[:3] = 0.0
+    return values
+
+
+def test_sketch_quantiles_within_accuracy():
+    values = temperatures(0, 10000)
+    values = values[~np.isnan(values)]
+    sketch = QuantileSketch(ACCURACY)
+    sketch.add(values, np.ones(len(values)))
+    for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+        exact = np.sort(values)[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= ACCURACY * abs(exact)
+    assert sketch.count() == len(values)
+
+
+def test_sketch_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_round_trip():
+    summary = summarize(temperatures(0, 5000), np.linspace(-50, 150, 6))
+    loaded = HistogramSummary.from_bytes(summary.to_bytes())
+    assert np.array_equal(loaded.edges, summary.edges)
+    assert np.array_equal(loaded.counts, summary.counts)
+    assert (loaded.minimum, loaded.maximum, loaded.temperatures, loaded.nulls, loaded.outside, loaded.approximate) == (
+        summary.minimum, summary.maximum, summary.temperatures, summary.nulls, summary.outside, summary.approximate)
+    assert (loaded.sketch.positive, loaded.sketch.negative, loaded.sketch.zero) == (
+        summary.sketch.positive, summary.sketch.negative, summary.sketch.zero)
+
+
+def test_round_trip_rejects_other_blobs():
+    with pytest.raises(ValueError):
+        HistogramSummary.from_bytes(b'XXXX' + summarize(temperatures(0, 10), [0, 1]).to_bytes()[4:])
+
+
+def test_merge_shared_edges_exactly():
+    edges = np.linspace(-50, 150, 6)
+    first, second = temperatures(0, 5000), temperatures(1, 3000)
+    merged = HistogramSummary.from_bytes(summarize(first, edges).to_bytes()).merge(
+        HistogramSummary.from_bytes(summarize(second, edges).to_bytes()))
+    whole = summarize(np.concatenate([first, second]), edges)
+    assert not merged.approximate
+    assert np.array_equal(merged.counts, whole.counts)
+    assert (merged.temperatures, merged.nulls, merged.outside) == (whole.temperatures, whole.nulls, whole.outside)
+    assert merged.percentiles([50, 90]) == whole.percentiles([50, 90])
+
+
+def test_merge_derived_edges_approximately():
+    first, second = temperatures(0, 5000), temperatures(1, 3000)
+    edges = [np.histogram_bin_edges(values[~np.isnan(values)], bins=5) for values in (first, second)]
+    merged = summarize(first, edges[0]).merge(summarize(second, edges[1]))
+    values = np.concatenate([first, second])
+    whole = np.histogram(values[~np.isnan(values)], bins=5)
+    assert merged.approximate
+    assert np.allclose(merged.edges, whole[1])
+    assert merged.counts.sum() == pytest.approx(whole[0].sum())
+    assert np.abs(merged.counts - whole[0]).max() <= 0.02 * whole[0].sum()
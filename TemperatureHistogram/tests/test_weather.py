@@ -0,0 +1,91 @@
+"""
+Exercise the forecast fetch against a local OpenWeatherMap API stub.
+"""
+
+import asyncio
+import time
+
+from aiohttp import web
+
+from TemperatureHistogram import weather
+from TemperatureHistogram.geolocation import LocationDB
+
+FORECAST_BODY = {'list': [{'dt': 1500000000, 'temp': {'max': 300.0}}]}
+
+
+def fetch(settings, cells, responses):
+    """
+    Fetch forecasts for grid cells from a local OpenWeatherMap API stub.
+
+    :param settings: `settings` fixture.
+    :param cells: List of grid cell latitude, longitude.
+    :param responses: Dictionary of grid cell latitude to list of the status codes the stub returns for it in turn,
+    after which it returns a forecast.
+    :return: Number of grid cells whose forecast couldn't be fetched, and dictionary of grid cell latitude to list of
+    its request times.
+    """
+
+    requests = {}
+
+    async def forecast(request):
+        latitude = float(request.query['lat'])
+        requests.setdefault(latitude, []).append(time.monotonic())
+        statuses = responses.get(latitude, [])
+        if len(requests[latitude]) <= len(statuses):
+            return web.Response(status=statuses[len(requests[latitude]) - 1], headers={'Retry-After': '0'})
+        return web.json_response(FORECAST_BODY)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get(weather.FORECAST_ROUTE, forecast)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        settings['owm_api_url'] = 'http://127.0.0.1:{}'.format(runner.addresses[0][1])
+        try:
+            return await weather._fetch_forecasts({cell: [] for cell in cells})
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run()), requests
+
+
+def test_requests_spaced_at_rate_limit(settings):
+    settings['owm_rpm'] = 600
+    settings['owm_concurrency'] = 4
+    failures, requests = fetch(settings, [(float(latitude), 0.0) for latitude in range(6)], {})
+    assert failures == 0
+    times = sorted(t for latitude_times in requests.values() for t in latitude_times)
+    assert len(times) == 6
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.09  # 600 requests per minute, less timer slack
+    assert LocationDB().select_('SELECT COUNT(*) FROM forecast_cache')[0][0] == 6
+
+
+def test_retries_rate_limited_and_server_errors(settings, monkeypatch):
+    settings['owm_rpm'] = 6000
+    monkeypatch.setattr(weather, 'RETRY_BACKOFF', 0.01)
+    failures, requests = fetch(settings, [(1.0, 0.0), (2.0, 0.0)], {1.0: [429, 429], 2.0: [500, 503]})
+    assert failures == 0
+    assert {latitude: len(times) for latitude, times in requests.items()} == {1.0: 3, 2.0: 3}
+    assert LocationDB().select_('SELECT COUNT(*) FROM forecast_failures')[0][0] == 0
+
+
+def test_gives_up_after_retries(settings, monkeypatch):
+    settings['owm_rpm'] = 6000
+    settings['owm_retries'] = 2
+    monkeypatch.setattr(weather, 'RETRY_BACKOFF', 0.01)
+    failures, requests = fetch(settings, [(1.0, 0.0)], {1.0: [503] * 5})
+    assert failures == 1
+    assert len(requests[1.0]) == 3
+    assert LocationDB().select_('SELECT retryable, attempts FROM forecast_failures') == [(1, 1)]
+
+
+def test_records_client_errors_without_retrying(settings):
+    settings['owm_rpm'] = 6000
+    failures, requests = fetch(settings, [(1.0, 0.0), (2.0, 0.0)], {1.0: [404]})
+    assert failures == 1
+    assert {latitude: len(times) for latitude, times in requests.items()} == {1.0: 1, 2.0: 1}
+    assert LocationDB().select_('SELECT cell_latitude, retryable, reason FROM forecast_failures') == [
+        (1.0, 0, "OpenWeatherMap API returned '404'")]
+    assert LocationDB().select_('SELECT cell_latitude FROM forecast_cache') == [(2.0,)]
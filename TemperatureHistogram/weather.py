@@ -2,34 +2,443 @@
 Exercise weather module.
 """
 
+import asyncio
+import datetime
 import json
 import logging
 import random
+import signal
 import time
-from socket import timeout
+from operator import itemgetter
 
-import pyowm
-from urllib3.exceptions import NewConnectionError, ReadTimeoutError
+import aiohttp
+import numpy as np
 
-from TemperatureHistogram.geolocation import LocationDB, gen_epoch
+from TemperatureHistogram import sampling
+from TemperatureHistogram.geolocation import LocationDB, LocationWriter, gen_epoch
 from TemperatureHistogram.handlers import GracefulException
 from TemperatureHistogram.settings import app_settings
 
+FORECAST_ROUTE = '/data/2.5/forecast/daily'  # https://openweathermap.org/forecast16
+FORECAST_TIMEOUT = 30  # Seconds allowed per forecast request
+RETRY_BACKOFF = 1  # Seconds waited before the first retry, doubling per retry
+RETRY_BACKOFF_MAX = 60  # Most seconds waited between retries
+UPDATE_FORECAST_SQL = 'UPDATE locations SET forecast_temperature = ?, forecast_epoch = ? WHERE ip = ?'
+INSERT_FORECAST_CACHE_SQL = '''
+    INSERT OR REPLACE INTO forecast_cache
+    (cell_latitude, cell_longitude, forecast_day, forecast_temperature, forecast_epoch, response_epoch)
+    VALUES (?, ?, ?, ?, ?, ?)
+    '''
+# Failures count attempts across runs, for the grid cell's forecast day
+INSERT_FORECAST_FAILURE_SQL = '''
+    INSERT INTO forecast_failures
+    (cell_latitude, cell_longitude, forecast_day, attempts, retryable, reason, failure_epoch)
+    VALUES (?, ?, ?, 1, ?, ?, ?)
+    ON CONFLICT (cell_latitude, cell_longitude, forecast_day) DO UPDATE SET
+    attempts = attempts + 1, retryable = excluded.retryable, reason = excluded.reason,
+    failure_epoch = excluded.failure_epoch
+    '''
+FLUSH_INTERVAL = 5  # Most seconds forecast progress is buffered before it's written, so little is lost on a crash
+
+
+class _UnauthorizedError(Exception):
+    """
+    OpenWeatherMap API rejected the API key. Raised out of the event loop, as no forecast can be fetched.
+    """
+
+
+class _ForecastFailure(Exception):
+    """
+    A grid cell's forecast couldn't be fetched.
+    """
+
+    def __init__(self, reason, retryable):
+        """
+
+        :param reason: Failure description.
+        :param retryable: Whether the failure is transient, and the forecast should be fetched again by the next run.
+        """
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.retryable = retryable
+
+
+class TokenBucket(object):
+    """
+    Asynchronous token bucket rate limiter. Tokens are added continuously at the configured rate, up to the bucket's
+    capacity, and every request takes one token, waiting until one is available.
+
+    With a capacity of one, requests are spaced evenly at exactly the configured rate, however long each takes, rather
+    than sent in bursts followed by a fixed sleep.
+    """
+
+    def __init__(self, rate_per_minute, capacity=1):
+        """
+
+        :param rate_per_minute: Tokens added per minute.
+        :param capacity: Most tokens held, i.e. largest burst of requests allowed.
+        """
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+
+    async def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def _fetch_forecast(session, bucket, latitude, longitude):
+    """
+    Fetch daily weather forecast for a coordinate, retrying with exponential backoff when rate limited (429), or on
+    server errors (5xx), timeouts, connection failures, and malformed responses.
+
+    :param session: `aiohttp.ClientSession`.
+    :param bucket: `TokenBucket` every request, including retries, is rate limited by.
+    :param latitude: Latitude.
+    :param longitude: Longitude.
+    :return: Forecast days, as `_forecast_days` extracts them.
+    :raise _ForecastFailure: When the forecast couldn't be fetched.
+    """
+
+    url = app_settings['owm_api_url'] + FORECAST_ROUTE
+    params = {'lat': str(latitude), 'lon': str(longitude), 'cnt': '2', 'APPID': app_settings['owm_api_key']}
+    retries = app_settings['owm_retries']
+    for attempt in range(retries + 1):
+        await bucket.acquire()
+        retry_after = None
+        try:
+            logging.debug("Fetching daily weather forecast for latitude, longitude '%s,%s'", latitude, longitude)
+            async with session.get(url, params=params) as response:
+                if response.status == 200:
+                    return _forecast_days(await response.read())
+                elif response.status == 401:
+                    raise _UnauthorizedError()
+                elif response.status != 429 and response.status < 500:
+                    # Abnormal return for this location, e.g. not found or invalid latitude, longitude
+                    raise _ForecastFailure("OpenWeatherMap API returned '{}'".format(response.status), False)
+                reason = "OpenWeatherMap API returned '{}'".format(response.status)
+                retry_after = response.headers.get('Retry-After')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            reason = "OpenWeatherMap API failed: {}".format(repr(e))
+        except (ValueError, KeyError, TypeError) as e:
+            reason = "OpenWeatherMap API returned malformed forecast: {}".format(repr(e))
+        if attempt == retries:
+            raise _ForecastFailure("{} (gave up after {} retries)".format(reason, retries), True)
+        if retry_after is not None and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = random.uniform(0.5, 1) * min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)
+        logging.debug("%s for latitude, longitude '%s,%s'. Retrying in %.1fsec.", reason, latitude, longitude, delay)
+        await asyncio.sleep(delay)
+
+
+def _day_epoch(epoch):
+    """
+    Epoch of the start of the day an epoch falls on, as `gen_epoch` calculates it for the current day.
+
+    :param epoch: Epoch seconds.
+    :return: Day's epoch seconds as integer.
+    """
+
+    return int(datetime.date.fromtimestamp(epoch).strftime('%s'))
+
+
+def _forecast_days(body):
+    """
+    Decode forecast days straight from a forecast response's raw body, keeping only each day's epoch (`dt`), and high
+    temperature (`temp.max`), converted from kelvin to fahrenheit.
+
+    :param body: Forecast response body bytes.
+    :return: List of forecast day epoch, and forecast high temperature in fahrenheit.
+    """
+
+    return [
+        (int(forecast_day['dt']), (float(forecast_day['temp']['max']) - 273.15) * 9/5 + 32)  # Convert to fahrenheit
+        for forecast_day in json.loads(body).get('list', [])]
+
+
+def _load_forecast_cache():
+    """
+    Load forecast cache entries from the current day on, fetched within the last `forecast_cache_ttl` hours.
+
+    :return: Dictionary of grid cell latitude, longitude to its list of forecast day epoch, and forecast high
+    temperature in fahrenheit, of which the first is the current day's.
+    """
+
+    rows = LocationDB().select_(
+        '''
+        SELECT cell_latitude, cell_longitude, forecast_day, forecast_epoch, forecast_temperature FROM forecast_cache
+        WHERE forecast_day >= ? AND response_epoch >= ? ORDER BY forecast_day
+        ''', gen_epoch(0), int(time.time()) - app_settings['forecast_cache_ttl'] * 3600)
+    cache = {}
+    for cell_latitude, cell_longitude, forecast_day, forecast_epoch, forecast_temperature in rows:
+        days = cache.setdefault((cell_latitude, cell_longitude), [])
+        if days or forecast_day == gen_epoch(0):
+            days.append((forecast_epoch, forecast_temperature))
+    return {cell: days for cell, days in cache.items() if days}
+
+
+def _cache_entries(cell, forecast_days):
+    """
+    Build a grid cell's forecast cache entries, keyed by the day each forecast day falls on.
+
+    :param cell: Grid cell latitude, longitude.
+    :param forecast_days: List of forecast day epoch, and forecast high temperature in fahrenheit.
+    :return: List of forecast cache entries, as expected by `INSERT_FORECAST_CACHE_SQL`.
+    """
+
+    response_epoch = int(time.time())
+    return [
+        (cell[0], cell[1], _day_epoch(rt), forecast_temperature, rt, response_epoch)
+        for rt, forecast_temperature in forecast_days]
+
+
+def purge_forecast_cache(expired_only=True):
+    """
+    Purge the forecast cache, and forecast failures.
+
+    :param expired_only: Whether to only purge entries for past days, or fetched longer ago than `forecast_cache_ttl`
+    hours, rather than every entry.
+    """
+
+    location_db = LocationDB()
+    count = location_db.select_('SELECT COUNT(*) FROM forecast_cache')[0][0]
+    if expired_only:
+        location_db.update_(
+            'DELETE FROM forecast_cache WHERE forecast_day < ? OR response_epoch < ?',
+            gen_epoch(0), int(time.time()) - app_settings['forecast_cache_ttl'] * 3600)
+        location_db.update_('DELETE FROM forecast_failures WHERE forecast_day < ?', gen_epoch(0))
+    else:
+        location_db.update_('DELETE FROM forecast_cache')
+        location_db.update_('DELETE FROM forecast_failures')
+    purged = count - location_db.select_('SELECT COUNT(*) FROM forecast_cache')[0][0]
+    logging.info("Purged {} forecast cache entries.".format(purged))
+
+
+def warm_forecast_cache():
+    """
+    Fetch forecasts for every grid cell holding a geolocated location, and missing from the forecast cache, without
+    updating locations. Lets a later run update its locations from the forecast cache alone.
+    """
+
+    rows = LocationDB().select_(
+        'SELECT ip, latitude, longitude, forecast_epoch, hits FROM locations WHERE geolocated = 1')
+    cache = _load_forecast_cache()
+    cells = {cell: [] for cell in _grid_cells(rows) if cell not in cache}
+    logging.info("Warming forecast cache for {} grid cell(s) missing from it.".format(len(cells)))
+    if cells:
+        try:
+            asyncio.run(_fetch_forecasts(cells))
+        except _UnauthorizedError:
+            raise GracefulException("Invalid OpenWeatherMap API key!")
+        except asyncio.CancelledError:
+            raise GracefulException("Forecast cache warming was interrupted! Its progress is resumed by the next run.")
+
+
+def _grid_cells(rows):
+    """
+    Group locations by forecast grid cell, i.e. their coordinates rounded to `forecast_grid_precision` decimal places.
+    Locations without coordinates are left out. Grid cells are ordered by their locations' total hits, busiest first,
+    so when a forecast update is cut short by the rate limit, a failure, or an interruption, the forecasts left stale
+    are those of the fewest log file entries.
+
+    :param rows: Location rows, ordered as ip, latitude, longitude, forecast_epoch, and hits.
+    :return: Dictionary of grid cell latitude, longitude to list of its locations' ip, and forecast_epoch.
+    """
+
+    precision = app_settings['forecast_grid_precision']
+    cells = {}
+    cell_hits = {}
+    for ip, latitude, longitude, forecast_epoch, hits in rows:
+        if latitude is None or longitude is None:
+            logging.debug("Skipping forecast for IP '%s' without latitude, longitude.", ip)
+            continue
+        cell = (round(latitude, precision), round(longitude, precision))
+        cells.setdefault(cell, []).append((ip, forecast_epoch))
+        cell_hits[cell] = cell_hits.get(cell, 0) + (hits or 0)
+    order = sorted(cells, key=cell_hits.get, reverse=True)
+    if order:
+        logging.debug(
+            "Busiest forecast grid cell '{},{}' has {} hits, quietest has {}."
+            .format(order[0][0], order[0][1], cell_hits[order[0]], cell_hits[order[-1]]))
+    return {cell: cells[cell] for cell in order}
+
+
+def _cell_updates(cell_locations, forecast_days):
+    """
+    Fan a grid cell's forecast out to its locations, picking each location's first forecast day newer than its forecast
+    epoch, for all of the grid cell's locations at once.
+
+    :param cell_locations: List of the grid cell's locations' ip, and forecast_epoch.
+    :param forecast_days: Grid cell's list of forecast day epoch, and forecast high temperature in fahrenheit.
+    :return: List of forecast_temperature, forecast_epoch, and ip, as expected by `UPDATE_FORECAST_SQL`.
+    """
+
+    if not forecast_days:
+        return []
+    # A location's first newer forecast day is the first whose epoch, or any earlier day's, is newer than its own
+    newest_epochs = np.maximum.accumulate(np.array([rt for rt, _ in forecast_days], dtype=np.int64))
+    days = np.searchsorted(
+        newest_epochs, np.array([forecast_epoch for _, forecast_epoch in cell_locations], dtype=np.int64),
+        side='right')
+    updates = [
+        (forecast_days[day][1], forecast_days[day][0], ip)
+        for (ip, _), day in zip(cell_locations, days.tolist()) if day < len(forecast_days)]
+    logging.debug("Updating %s of %s location(s) with the grid cell's forecast.", len(updates), len(cell_locations))
+    return updates
+
+
+async def _fetch_forecasts(cells, writer=None):
+    """
+    Fetch one forecast per grid cell, using `owm_concurrency` concurrent requests, rate limited to exactly `owm_rpm`
+    requests per minute, and fan each grid cell's forecast out to its locations as it arrives. Forecasts are also
+    added to the forecast cache, and grid cells whose forecast couldn't be fetched to the forecast failures.
+
+    Progress is written every `FLUSH_INTERVAL` seconds as it's made, and whatever is buffered when the fetch is
+    interrupted, e.g. by SIGTERM, so a later run resumes with the grid cells still stale.
+
+    :param cells: Dictionary of grid cell latitude, longitude to list of its locations' ip, and forecast_epoch.
+    :param writer: `LocationWriter` for `UPDATE_FORECAST_SQL` buffering location updates, or None to only add
+    forecasts to the forecast cache.
+    :return: Number of grid cells whose forecast couldn't be fetched.
+    """
+
+    bucket = TokenBucket(app_settings['owm_rpm'])
+    queue = iter(cells.items())
+    forecast_day = gen_epoch(0)
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        for (latitude, longitude), cell_locations in queue:
+            try:
+                forecast_days = await _fetch_forecast(session, bucket, latitude, longitude)
+            except _ForecastFailure as e:
+                logging.error(
+                    "Couldn't fetch forecast for latitude, longitude '{},{}': {}. {} location(s) keep their stale "
+                    "forecast{}.".format(
+                        latitude, longitude, e.reason, len(cell_locations),
+                        ", and will be retried by the next run" if e.retryable else ""))
+                failures += 1
+                failure_writer.write_(latitude, longitude, forecast_day, int(e.retryable), e.reason, int(time.time()))
+                continue
+            cache_writer.write_many_(_cache_entries((latitude, longitude), forecast_days))
+            if writer is not None:
+                writer.write_many_(_cell_updates(cell_locations, forecast_days))
+
+    # Cancel the fetch on SIGTERM, e.g. `docker stop`, so buffered progress is written on the way out
+    try:
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
+
+    timeout = aiohttp.ClientTimeout(total=FORECAST_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=app_settings['owm_concurrency'])
+    with LocationWriter(INSERT_FORECAST_CACHE_SQL, flush_interval=FLUSH_INTERVAL) as cache_writer, \
+            LocationWriter(INSERT_FORECAST_FAILURE_SQL, flush_interval=FLUSH_INTERVAL) as failure_writer:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await asyncio.gather(*(worker() for _ in range(app_settings['owm_concurrency'])))
+    return failures
+
+
+def _skip_failed_cells(cells):
+    """
+    Remove grid cells whose forecast already failed for the current day, for a reason retrying won't fix, e.g. an
+    invalid latitude, longitude.
+
+    :param cells: Dictionary of grid cell latitude, longitude to list of its locations' ip, and forecast_epoch.
+    """
+
+    failed = LocationDB().select_(
+        'SELECT cell_latitude, cell_longitude FROM forecast_failures WHERE forecast_day = ? AND retryable = 0',
+        gen_epoch(0))
+    skipped = [cells.pop(tuple(cell)) for cell in failed if tuple(cell) in cells]
+    if skipped:
+        logging.info(
+            "Skipping {} grid cell(s) whose forecast can't be fetched for the current day.".format(len(skipped)))
+
+
+def _draw_forecast_sample(rows):
+    """
+    Draw a stratified sample of locations, stratified by country, and region, and sized to estimate histogram bucket
+    proportions within `forecast_sample_error` at `forecast_sample_confidence`. Strata too small for their share of the
+    sample are collapsed. The sample is the same on every run, as long as the locations are.
+
+    :param rows: Location rows, starting with ip, country, and region.
+    :return: Dictionary of stratum country, region to list of its locations' IPs, and of stratum to its sampled IPs.
+    """
+
+    error, confidence = app_settings['forecast_sample_error'], app_settings['forecast_sample_confidence']
+    strata = {}
+    for row in rows:
+        strata.setdefault((row[1] or '', row[2] or ''), []).append(row[0])
+    # Small regions are collapsed into their country, and small countries into a single stratum
+    strata = sampling.collapse(
+        strata, sampling.sample_size(len(rows), error, confidence), (lambda s: (s[0], ''), lambda s: ('', '')))
+    return strata, sampling.draw(strata, error, confidence)
+
+
+def _sampled_stale_locations(location_db, current_epoch):
+    """
+    Find stale locations within the stratified sample of locations, so a forecast update fetches far fewer forecasts,
+    while the histogram is still estimated within `forecast_sample_error`.
+
+    :param location_db: `LocationDB`.
+    :param current_epoch: Current day's forecast epoch.
+    :return: Location rows, ordered as ip, latitude, longitude, forecast_epoch, and hits.
+    """
+
+    rows = location_db.select_('SELECT ip, country, region, latitude, longitude, forecast_epoch, hits FROM locations')
+    strata, sample = _draw_forecast_sample(rows)
+    sampled = set(ip for ips in sample.values() for ip in ips)
+    stale = [row[:1] + row[3:] for row in rows if row[0] in sampled and row[5] < current_epoch]
+    logging.info(
+        "Sampled {} of {} location(s) across {} strata (country, region), for a {}% margin of error at {}% "
+        "confidence. {} sampled location(s) have a stale forecast.".format(
+            len(sampled), len(rows), len(strata), app_settings['forecast_sample_error'] * 100,
+            app_settings['forecast_sample_confidence'], len(stale)))
+    return stale
+
 
 def update_forecast_high_temperatures():
     """
     Ascertain next day's high temperature relative to a geographic location. Uses OpenWeatherMap API
-    (https://openweathermap.org/api) via PyOWM library.
-
-    PyOWM reference: https://pyowm.readthedocs.io/en/latest/usage-examples-v2/weather-api-usage-examples.html
+    (https://openweathermap.org/api) via an asynchronous `aiohttp` client.
 
-    Using '/data/2.5/forecast/daily' route referenced here: https://openweathermap.org/forecast5
+    Using '/data/2.5/forecast/daily' route referenced here: https://openweathermap.org/forecast16
 
     If a location's `forecast_epoch` is less than the next day's offered epoch, the forecast temperature is stale and
     should be updated.
 
     We'll accept the first forecast day's information if the epoch is newer than a location's own, i.e., catch the next
     day's forecast before considering the day after next, etc.
+
+    Stale locations are grouped by forecast grid cell, and a single forecast is fetched per grid cell, unless the
+    forecast cache already holds the grid cell's forecast for the current day. Forecasts are fetched concurrently,
+    while a token bucket spaces requests at exactly `owm_rpm` requests per minute, so request latency doesn't add onto
+    the rate limited time to complete. Location updates are buffered, and written within large transactions on a
+    single connection for the whole update.
+
+    Progress is written durably as it's made, and grid cells whose forecast couldn't be fetched are recorded, and keep
+    their stale forecast, rather than ending the application. An interrupted or failed update is resumed by the next
+    run, as locations already updated are no longer stale, and forecasts already fetched are within the forecast
+    cache.
+
+    When `forecast_sample_error` is set, only stale locations within a stratified sample of locations are updated, see
+    `_sampled_stale_locations`.
     """
 
     # Create common database object
@@ -38,114 +447,130 @@ def update_forecast_high_temperatures():
     # Find locations update eligible
     current_epoch = gen_epoch(0)
     logging.info("Querying locations with a forecast epoch older than `{}`".format(current_epoch))
-    rows = location_db.select_(
-        'SELECT ip, latitude, longitude, forecast_epoch FROM locations WHERE forecast_epoch < {}'
-        .format(current_epoch))
+    if app_settings['forecast_sample_error'] > 0:
+        rows = _sampled_stale_locations(location_db, current_epoch)
+    else:
+        rows = location_db.select_(
+            'SELECT ip, latitude, longitude, forecast_epoch, hits FROM locations WHERE forecast_epoch < ?',
+            current_epoch)
     if not rows or len(rows) < 0:
         logging.info("No locations with stale forecast data.")
         return
-    else:
 
-        # Update locations with latest forecast temperature
-        owm = pyowm.OWM(app_settings['owm_api_key'], use_ssl=True)
+    with LocationWriter(UPDATE_FORECAST_SQL, sort_key=itemgetter(2), flush_interval=FLUSH_INTERVAL) as writer:
+        if app_settings['faux_temperature_data'] == 1:
+            forecast_epoch = gen_epoch(1)
+            writer.write_many_([(random.uniform(70, 79), forecast_epoch, row[0]) for row in rows])
+            return
+
+        # Update locations with latest forecast temperature, first from the forecast cache
+        purge_forecast_cache()
+        cells = _grid_cells(rows)
+        cache = _load_forecast_cache()
+        updates = 0
+        for cell in [cell for cell in cells if cell in cache]:
+            cell_updates = _cell_updates(cells.pop(cell), cache[cell])
+            writer.write_many_(cell_updates)
+            updates += len(cell_updates)
+        logging.info("Updated {} location(s) from the forecast cache.".format(updates))
+        _skip_failed_cells(cells)
+        if not cells:
+            return
+
         owm_rpm = app_settings['owm_rpm']
-        location_count = len(rows)
-        rate_limiter = 0  # Counter for rpm
-        sleep_time = 60  # Time to sleep per rpm intervals. Defaults to 1min. interval
-        time_to_complete = int((location_count / 60) + (len(rows) / 60))  # Estimate time to complete queries
+        time_to_complete = (len(cells) - 1) / owm_rpm  # Requests are spaced evenly at the rate limit
+        logging.info(
+            "Coalesced {} stale location(s) missing from the forecast cache into {} forecast grid cell(s) of {} "
+            "decimal places.".format(
+                sum(len(cell_locations) for cell_locations in cells.values()), len(cells),
+                app_settings['forecast_grid_precision']))
         logging.info(
-            "It is estimated to take {}min. to complete fetching forecasts for {} location(s) due to OpenWeatherMap "
-            "API rate limiter: {} queries/min. + {}sec. sleep timer each interval"
-            .format(time_to_complete, location_count, owm_rpm, sleep_time))
-        for row in rows:
-            rate_limiter += 1
-            ip, latitude, longitude, forecast_epoch = row[0], row[1], row[2], row[3]
-            if app_settings['faux_temperature_data'] == 1:
-                forecast_temperature, forecast_epoch = random.uniform(70, 79), gen_epoch(1)
-            else:
-                try:
-                    # Fetch weather forecast
-                    logging.debug("Fetching daily weather forecast for IP '{}'".format(ip))
-                    forecast = owm.daily_forecast_at_coords(latitude, longitude, limit=2)
-                    forecast_json = json.loads(forecast.get_forecast().to_JSON())  # Load weather forecast
-                    weathers = forecast_json['weathers']  # Build list of forecast days
-                    # Loop forecast days and see if one is newer than our existing forecast epoch
-                    for forecast_day in weathers:
-                        forecast_day = dict(forecast_day)
-                        rt = forecast_day['reference_time']
-                        rt = int(rt)
-                        logging.debug(
-                            "Comparing IP '{}' forecast epoch '{}' to offered forecast day epoch '{}'"
-                            .format(ip, forecast_epoch, rt))
-                        if rt > forecast_epoch:
-                            logging.debug("Accepting offered forecast day epoch '{}' for IP '{}'".format(rt, ip))
-                            forecast_epoch = rt
-                            forecast_temperature = float(forecast_day['temperature']['max'])
-                            forecast_temperature = (forecast_temperature - 273.15) * 9/5 + 32  # Convert to fahrenheit
-                            break
-                        else:
-                            logging.debug(
-                                "Rejecting offered forecast day epoch '{}' for IP '{} as location epoch is newer"
-                                .format(rt, ip))
-                            continue
-                except ValueError:
-                    logging.debug(
-                        "OpenWeatherMap API failure for '{}: Invalid latitude, longitude '{},{}'"
-                        .format(ip, latitude, longitude))
-                except owm.exceptions.api_response_error.UnauthorizedError:
-                    """Catch OWM API key failures."""
-                    raise GracefulException("Invalid OpenWeatherMap API key!")
-                except NewConnectionError:
-                    """Catch OWM API new connection failures."""
-                    raise GracefulException(
-                        "Couldn't establish connection with OpenWeatherMap API! Please check network connectivity, and "
-                        "API service.")
-                except owm.exceptions.api_call_error.APIInvalidSSLCertificateError:
-                    """Catch OWM API invalid SSL certification failures."""
-                    raise GracefulException(
-                        "Couldn't establish session with OpenWeatherMap API! Invalid SSL certificate.")
-                except timeout or ReadTimeoutError or owm.exceptions.api_call_error.APICallTimeoutError:
-                    """Catch OWM API connection breakdowns."""
-                    raise GracefulException("Connection with OpenWeatherMap API timed out!")
-                except pyowm.exceptions.api_call_error.APICallError as e:
-                    """Catch OWM API internal errors, i.e., 500s, et al."""
-                    raise GracefulException("OpenWeatherMap API returned error: {}".format(e.cause))
-                except owm_rpm.exceptions.api_response_error.APIResponseError as e:
-                    """Catch OWM API abnormal returns for a location."""
-                    logging.error(
-                        "OpenWeatherMap API returned '{}' for IP '{}'".format(e.status_code, ip))
-                except owm.exceptions.api_response_error.NotFoundError as e:
-                    """Catch OWM API returning a location not found."""
-                    logging.error(
-                        "OpenWeatherMap API returned 'not found' for IP '{}'. Cause: '{}'".format(ip, e.cause))
-
-            # Update location database entry
-            logging.debug(
-                "Updating location IP '{}' with forecast high temperature '{}'".format(ip, forecast_temperature))
-            location_db.update_(
-                'UPDATE locations SET forecast_temperature = "{}", forecast_epoch = "{}" WHERE ip = "{}"'
-                .format(forecast_temperature, forecast_epoch, ip))
-
-            # Basic rate limiting capability in lieu of a more complex object, or context manager
-            if rate_limiter == owm_rpm:
-                logging.debug("OpenWeatherMap API rate limiter sleeping for {}sec.".format(sleep_time))
-                rate_limiter = 0
-                time.sleep(sleep_time)
-
-
-def forecast_high_temperature_list():
-    """
-    Produces list of forecast high temperatures.
-    :return: Temperature list.
-    """
-
-    temperature_list = []
+            "It is estimated to take {:.1f}min. to complete fetching forecasts for {} grid cell(s) due to "
+            "OpenWeatherMap API rate limiter: {} queries/min., {} concurrent queries"
+            .format(time_to_complete, len(cells), owm_rpm, app_settings['owm_concurrency']))
+        try:
+            failures = asyncio.run(_fetch_forecasts(cells, writer))
+        except _UnauthorizedError:
+            logging.error("Invalid OpenWeatherMap API key! Continuing with locations' fresh forecasts only.")
+            return
+        except asyncio.CancelledError:
+            raise GracefulException("Forecast update was interrupted! Its progress is resumed by the next run.")
+        if failures:
+            logging.warning(
+                "Forecasts for {} of {} grid cell(s) couldn't be fetched. Continuing with locations' fresh forecasts "
+                "only.".format(failures, len(cells)))
+
+
+# Forecast temperature, or null when missing or bogus, i.e. not numeric
+TEMPERATURE_COLUMN = "CASE WHEN typeof(forecast_temperature) IN ('integer', 'real') THEN forecast_temperature END"
+# Histogram group labels. Regions are only unique within their country, so are labeled as ISO 3166-2 codes.
+GROUP_COLUMNS = {
+    'country': "COALESCE(NULLIF(country, ''), 'unknown')",
+    'region': "COALESCE(NULLIF(country, ''), 'unknown') || '-' || COALESCE(NULLIF(region, ''), 'unknown')"
+}
+
+
+def forecast_temperature_range():
+    """
+    Lowest, and highest forecast high temperature, of locations with a fresh forecast, i.e. for the current day on.
+
+    :return: Tuple of lowest, and highest temperature, each None when no location has a fresh forecast temperature.
+    """
+
+    return LocationDB().select_(
+        'SELECT MIN({0}), MAX({0}) FROM locations WHERE forecast_epoch >= ?'.format(TEMPERATURE_COLUMN),
+        gen_epoch(0))[0]
+
+
+def forecast_temperature_sample():
+    """
+    Draw the stratified sample of locations the histogram is estimated from, when `forecast_sample_error` is set. The
+    sample is the same one `update_forecast_high_temperatures` updated.
+
+    :return: `StratifiedSample`, or None when every location is counted.
+    """
+
+    if not app_settings['forecast_sample_error'] > 0:
+        return None
+    strata, sample = _draw_forecast_sample(LocationDB().select_('SELECT ip, country, region FROM locations'))
+    units = {ip: stratum for stratum, ips in enumerate(sample.values()) for ip in ips}
+    logging.info("Estimating histogram from a sample of {} location(s).".format(len(units)))
+    return sampling.StratifiedSample(
+        units, [len(ips) for ips in strata.values()], app_settings['forecast_sample_confidence'])
+
+
+def forecast_temperature_chunks(weighting='locations', sample=None, group_by=None):
+    """
+    Stream forecast high temperatures, of locations with a fresh forecast, i.e. for the current day on, from the
+    location database in chunks, so they're never all held at once. Locations whose forecast couldn't be updated are
+    left out, rather than counted with a stale forecast.
+
+    :param weighting: 'locations' to count each location once, or 'hits' to weight each location by its hits, i.e.
+    how many times it occurred within the log files.
+    :param sample: `StratifiedSample` to stream only the sampled locations of, or None to stream every location.
+    :param group_by: 'country', or 'region', to stream each location's group label along with its temperature, or None.
+    :return: Generator of arrays of temperatures (NaN when null), of their weights, or None when unweighted, of their
+    sample stratum indexes, or None when every location is streamed, and of their group labels, or None when ungrouped.
+    """
+
     location_db = LocationDB()
-    rows = location_db.select_('SELECT forecast_temperature FROM locations')
-    try:
-        for row in rows:
-            temperature_list.append(int(row[0]))  # Add first element of temperature row to list
-    except ValueError:
-        # Should catch bogus or None/null temperatures before here, but just in case
-        temperature_list.append(0)
-    return temperature_list
+    current_epoch = gen_epoch(0)
+    if sample is None:
+        stale = location_db.select_('SELECT COUNT(*) FROM locations WHERE forecast_epoch < ?', current_epoch)[0][0]
+        if stale:
+            logging.warning("Leaving {} location(s) with a stale forecast out of the histogram.".format(stale))
+    weighted = weighting == 'hits'
+    if weighted and not location_db.select_('SELECT COUNT(*) FROM locations WHERE hits > 0')[0][0]:
+        logging.warning("No hits recorded for locations. Falling back to counting each location once.")
+        weighted = False
+
+    columns = [TEMPERATURE_COLUMN, 'hits', 'ip' if sample is not None else GROUP_COLUMNS.get(group_by, 'NULL')]
+    sql = 'SELECT {} FROM locations WHERE forecast_epoch >= ?'.format(', '.join(columns))
+    for rows in location_db.select_chunks_(sql, current_epoch):
+        if sample is not None:
+            rows = [row for row in rows if row[2] in sample.units]
+        temperatures = np.array([row[0] for row in rows], dtype=np.float64)
+        weights = np.array([row[1] or 0 for row in rows], dtype=np.float64) if weighted else None
+        strata = None if sample is None else np.array([sample.units[row[2]] for row in rows], dtype=np.intp)
+        groups = None if group_by is None else np.array([row[2] for row in rows], dtype=str)
+        yield temperatures, weights, strata, groups